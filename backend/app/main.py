@@ -1,18 +1,30 @@
 import os
 
 from fastapi import FastAPI, UploadFile, File
-from fastapi.responses import JSONResponse
+from fastapi import Request, Query
+from fastapi.responses import JSONResponse, StreamingResponse, Response, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.exceptions import HTTPException as StarletteHTTPException
 from fastapi.staticfiles import StaticFiles
+from fastapi.concurrency import run_in_threadpool
 from fastapi import HTTPException
 import shutil
+import asyncio
+import hashlib
+import uuid
+import aiofiles
 from pathlib import Path
-from typing import List
-from utils.file_man import unzip_file
-from utils.scaner import start_scan, get_scan_status, collect_files
+from typing import List, Optional
+from utils.file_man import start_unzip, get_unzip_job, INCOMING_DIR, COPY_CHUNK_SIZE
+from utils.scaner import start_scan, get_scan_status, collect_files, file_status_events, \
+    register_files, clear_files, has_files, resume_scan, scan_single_file
+from utils.boilerplate import template_path, add_template_json, add_template_pdf, remove_template, list_templates
 from utils.ssf import find_exact_same_substrings
-from utils.pdf_show import render_image
+from utils.compare_jobs import submit_compare, get_compare_job
+from utils.result_view import page_relations, summarize_relations, rank_documents
+from utils.doc_cache import clear_text_cache
+from utils.pdf_show import render_image, clear_render_cache, prewarm_documents, IMAGE_DPI, IMAGE_FORMATS
+from utils.metrics import render_metrics, profile_call
 from pydantic import BaseModel
 import base64
 
@@ -32,37 +44,182 @@ app.add_middleware(
 UPLOAD_DIR = Path("uploads")
 UPLOAD_DIR.mkdir(exist_ok=True)
 
+
+@app.on_event("startup")
+async def resume_scan_jobs():
+    resume_scan()
+
+
 @app.post("/backend/upload")
 async def upload_file(file: UploadFile = File(...)):
     if not file.filename.endswith('.zip'):
         return {"error": "Only ZIP files are allowed"}
-    
-    file_bytes = await file.read()
-    unzip_file(file_bytes, UPLOAD_DIR)
-    
-    return {"message": "File uploaded and extracted successfully"}
+
+    # spool the upload to disk in chunks, it is extracted by a worker thread
+    os.makedirs(INCOMING_DIR, exist_ok=True)
+    zip_path = os.path.join(INCOMING_DIR, f"{uuid.uuid4().hex}.zip")
+    async with aiofiles.open(zip_path, 'wb') as f:
+        while True:
+            chunk = await file.read(COPY_CHUNK_SIZE)
+            if not chunk:
+                break
+            await f.write(chunk)
+    job = start_unzip(zip_path, UPLOAD_DIR, register_files)
+
+    return {"message": "File uploaded, extracting...", "upload_id": job.upload_id}
+
+
+@app.get("/backend/upload/{upload_id}")
+async def get_upload_status(upload_id: str):
+    job = get_unzip_job(upload_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return job.get_status()
 
 
 @app.post("/backend/cleanup")
 async def cleanup():
     if UPLOAD_DIR.exists():
         shutil.rmtree(UPLOAD_DIR)
+    clear_files()
+    clear_text_cache()
+    clear_render_cache()
     return {"message": "Upload directory cleaned successfully"}
 
 
 @app.post("/backend/scan")
 async def scan_files():
-    collect_files()
+    # uploads register their files, only walk the upload folder if nothing is known
+    if not has_files():
+        collect_files()
     start_scan()
     return {"message": "成功启动扫描..."}
 
 
+@app.post("/backend/template")
+async def upload_template(file: UploadFile = File(...)):
+    """
+    A template of the issuer, its text is masked in all documents before
+    matching. Either the pdf (it is scanned first) or its scanned json.
+    """
+    name = file.filename.lower()
+    if name.endswith('.json'):
+        raw = await file.read()
+        try:
+            name = await run_in_threadpool(add_template_json, file.filename, raw)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        return {"message": "模板已添加", "name": name}
+    if not name.endswith('.pdf'):
+        raise HTTPException(status_code=400, detail="Only PDF or scanned JSON templates are allowed")
+    pdf_path = template_path(file.filename)
+    os.makedirs(os.path.dirname(pdf_path), exist_ok=True)
+    async with aiofiles.open(pdf_path, 'wb') as f:
+        while True:
+            chunk = await file.read(COPY_CHUNK_SIZE)
+            if not chunk:
+                break
+            await f.write(chunk)
+    name = add_template_pdf(pdf_path, scan_single_file)
+    return {"message": "正在扫描模板...", "name": name}
+
+
+@app.get("/backend/template")
+async def get_templates():
+    return {"templates": list_templates()}
+
+
+@app.delete("/backend/template/{name}")
+async def delete_template(name: str):
+    if not remove_template(name):
+        raise HTTPException(status_code=404, detail="Template not found")
+    return {"message": "模板已删除"}
+
+
 @app.get("/backend/compare")
-async def compare_files():
-    results = find_exact_same_substrings()
+async def compare_files(incremental: bool = False, profile: bool = False, fuzzy: bool = False,
+                        boilerplate: bool = True):
+    if profile:
+        results, report = await run_in_threadpool(profile_call, find_exact_same_substrings, incremental=incremental,
+                                                  fuzzy=fuzzy, boilerplate=boilerplate)
+        return {**results, "profile": report}
+    results = await run_in_threadpool(find_exact_same_substrings, incremental=incremental, fuzzy=fuzzy,
+                                      boilerplate=boilerplate)
+    prewarm_documents(rank_documents(results))
     return results
 
 
+@app.post("/backend/compare")
+async def start_compare(incremental: bool = False, profile: bool = False, fuzzy: bool = False,
+                        boilerplate: bool = True):
+    job = submit_compare(incremental, profile, fuzzy, boilerplate)
+    return {"job_id": job.job_id, "message": "成功启动比对..."}
+
+
+@app.get("/backend/compare/{job_id}")
+async def get_compare_status(job_id: str):
+    job = get_compare_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Compare job not found")
+    return job.get_status()
+
+
+@app.get("/backend/compare/{job_id}/result")
+async def get_compare_result(job_id: str):
+    job = get_compare_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Compare job not found")
+    if job.result is None:
+        return JSONResponse(content=job.get_status(), status_code=202)
+    return job.result
+
+
+@app.get("/backend/compare/{job_id}/profile")
+async def get_compare_profile(job_id: str):
+    job = get_compare_job(job_id)
+    if job is None or not job.profile:
+        raise HTTPException(status_code=404, detail="Compare job not found or not profiled")
+    if job.report is None:
+        raise HTTPException(status_code=409, detail="Compare job not finished")
+    return job.report
+
+
+def get_compare_job_result(job_id):
+    job = get_compare_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Compare job not found")
+    if job.result is None:
+        raise HTTPException(status_code=409, detail="Compare job not finished")
+    return job.result
+
+
+@app.get("/backend/compare/{job_id}/ratio-matrix")
+async def get_compare_ratio_matrix(job_id: str):
+    result = get_compare_job_result(job_id)
+    return {"ratio_matrix": result['ratio_matrix'], "boilerplate_ratio": result.get('boilerplate_ratio', {}),
+            "prefilter": result.get('prefilter', {"enabled": False})}
+
+
+@app.get("/backend/compare/{job_id}/relations")
+async def get_compare_relations(job_id: str, source: str, target: str = None,
+                                offset: int = 0, limit: int = 50,
+                                min_length: int = 0, min_ratio: float = 0.0, sort: str = 'ratio'):
+    result = get_compare_job_result(job_id)
+    try:
+        if target is None:
+            return summarize_relations(result, source, min_length, min_ratio)
+        return page_relations(result, source, target, offset, limit, min_length, min_ratio, sort)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/backend/metrics")
+async def get_metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
 @app.get("/backend/file-status")
 async def get_file_status():
     data = get_scan_status()
@@ -71,6 +228,15 @@ async def get_file_status():
             status_code=200
         )
 
+@app.get("/backend/file-status/stream")
+async def stream_file_status():
+    return StreamingResponse(
+            file_status_events(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache"}
+        )
+
+
 @app.get("/backend/collect-info")
 async def get_file_status():
     collect_files()
@@ -84,25 +250,70 @@ async def get_file_status():
 class PdfInfo(BaseModel):
     file: str
     block: dict
+    # all blocks covered by the segment, see TextDocument.cover
+    spans: Optional[List[dict]] = None
+
+
+def page_boxes_of(pdf):
+    if pdf.spans:
+        return [(span['page'], span['bbox']) for span in pdf.spans]
+    return [(pdf.block['page'], pdf.block['bbox'])]
 
 
 @app.post("/backend/get_pdf_pair")
-async def get_pdf_pair(pdf_pair: List[PdfInfo]):
-    images = []
-    for pdf in pdf_pair:
-        from_file = pdf.file
-        bbox = pdf.block['bbox']
-        page = pdf.block['page']
-        page_boxes = [(page, bbox)]
-        offset = 0
-        image = render_image(from_file, page_boxes, offset)
-        images.append(base64.b64encode(image).decode('utf-8'))
+async def get_pdf_pair(pdf_pair: List[PdfInfo], dpi: int = Query(IMAGE_DPI, ge=36, le=300),
+                       crop: Optional[float] = Query(None, ge=0), format: str = 'png',
+                       quality: int = Query(85, ge=1, le=95)):
+    if format not in IMAGE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown image format {format}")
+    offset = 0
+    # both sides are rendered at the same time, off the event loop
+    images = await asyncio.gather(*[
+        run_in_threadpool(render_image, pdf.file, page_boxes_of(pdf), offset, dpi, crop, format, quality)
+        for pdf in pdf_pair
+    ])
+    images = [base64.b64encode(image).decode('utf-8') for image in images]
     return {
         "left_image": images[0],
         "right_image": images[1],
+        "mime_type": IMAGE_FORMATS[format][1],
         "message": "Successfully retrieved PDF images."
     }
 
+
+@app.get("/backend/pdf-image")
+async def get_pdf_image(request: Request, file: str, box: List[str] = Query([]),
+                        dpi: int = Query(IMAGE_DPI, ge=36, le=300), crop: Optional[float] = Query(None, ge=0),
+                        format: str = 'png', quality: int = Query(85, ge=1, le=95)):
+    """
+    One rendered pdf as an image. Every box is "page,x0,y0,x1,y1", the
+    response can be cached by the browser until the pdf changes.
+    """
+    if format not in IMAGE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown image format {format}")
+    if os.path.commonpath([os.path.abspath(file), os.path.abspath(UPLOAD_DIR)]) != os.path.abspath(UPLOAD_DIR) \
+            or not os.path.isfile(file):
+        raise HTTPException(status_code=404, detail="File not found")
+    try:
+        page_boxes = []
+        for value in box:
+            page, *bbox = value.split(',')
+            if len(bbox) != 4:
+                raise ValueError(value)
+            page_boxes.append((int(page), [float(v) for v in bbox]))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="A box is page,x0,y0,x1,y1")
+
+    stat = os.stat(file)
+    key = repr((stat.st_mtime_ns, stat.st_size, box, dpi, crop, format, quality))
+    etag = '"' + hashlib.sha1(key.encode('utf-8')).hexdigest() + '"'
+    headers = {"Cache-Control": "private, max-age=3600", "ETag": etag}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    image = await run_in_threadpool(render_image, file, page_boxes, 0, dpi, crop, format, quality)
+    return Response(content=image, media_type=IMAGE_FORMATS[format][1], headers=headers)
+
+
 class SPAStaticFiles(StaticFiles):
     async def get_response(self, path: str, scope):
         try:
@@ -0,0 +1,226 @@
+import os
+import json
+import threading
+import numpy as np
+from utils.winnowing import kgram_hashes
+from utils.doc_cache import load_text_document, prepare_text_document, build_text_document
+
+# shingles of this many characters make the document-frequency index
+BOILERPLATE_K = 16
+# shingles in more than this fraction of the documents are template text, off
+# (0) by default: in a tender, text shared by most bidders may well be the
+# collusion itself, only the uploaded templates are masked then
+BOILERPLATE_MAX_DF = float(os.environ.get("BOILERPLATE_MAX_DF", 0))
+# below this many documents the fraction says nothing, only templates count
+BOILERPLATE_MIN_DOCS = int(os.environ.get("BOILERPLATE_MIN_DOCS", 20))
+TEMPLATE_DIR = os.environ.get("BOILERPLATE_TEMPLATE_DIR", "templates")
+# masked characters get distinct codes above the paragraph separators, so
+# they never take part in a repeat
+MASK_BASE = 0x80000000
+
+
+def shingle_hashes(codes, k=BOILERPLATE_K):
+    """The distinct k-gram hashes of a text, sorted."""
+    return np.unique(kgram_hashes(codes, k))
+
+
+def find_common_shingles(paragraphs, max_df=BOILERPLATE_MAX_DF, k=BOILERPLATE_K):
+    """
+    The document-frequency index of the shingles of all paragraphs.
+
+    Returns:
+        The sorted uint64 hashes of the shingles found in more than max_df of
+        the paragraphs (and in two at least).
+    """
+    shingles = [shingle_hashes(codes, k) for codes in paragraphs]
+    if not shingles:
+        return np.zeros(0, dtype=np.uint64)
+    hashes, dfs = np.unique(np.concatenate(shingles), return_counts=True)
+    return hashes[dfs > max(1, int(max_df * len(paragraphs)))]
+
+
+def boilerplate_mask(codes, shingles, k=BOILERPLATE_K):
+    """Flags the characters of codes covered by one of the sorted shingles."""
+    mask = np.zeros(len(codes), dtype=bool)
+    hashes = kgram_hashes(codes, k)
+    if len(hashes) == 0 or len(shingles) == 0:
+        return mask
+    places = np.minimum(np.searchsorted(shingles, hashes), len(shingles) - 1)
+    starts = np.nonzero(shingles[places] == hashes)[0]
+    if len(starts) == 0:
+        return mask
+    coverage = np.zeros(len(codes) + 1, dtype=np.int32)
+    np.add.at(coverage, starts, 1)
+    np.add.at(coverage, starts + k, -1)
+    return np.cumsum(coverage[:-1]) > 0
+
+
+def suppress_boilerplate(paragraphs, max_df=BOILERPLATE_MAX_DF, template_shingles=None, k=BOILERPLATE_K):
+    """
+    Masks the template text of the paragraphs before matching: the shingles
+    of the templates and, if max_df > 0, those found in more than max_df of
+    the paragraphs (with BOILERPLATE_MIN_DOCS paragraphs or more).
+
+    Masked characters are replaced by codes occurring nowhere else, so the
+    positions (and the ratios computed from them) don't move while no segment
+    can contain a masked character.
+
+    Returns:
+        (the paragraphs, masked copies where needed, the masked fraction of
+        every paragraph)
+    """
+    common = np.zeros(0, dtype=np.uint64)
+    if max_df > 0 and len(paragraphs) >= BOILERPLATE_MIN_DOCS:
+        common = find_common_shingles(paragraphs, max_df, k)
+    if template_shingles is not None and len(template_shingles):
+        common = np.union1d(common, template_shingles)
+
+    masked = []
+    fractions = []
+    next_code = MASK_BASE
+    for codes in paragraphs:
+        mask = boilerplate_mask(codes, common, k)
+        count = int(mask.sum())
+        fractions.append(count / len(codes) if len(codes) else 0.0)
+        if count == 0:
+            masked.append(codes)
+            continue
+        codes = np.array(codes, dtype=np.uint32)
+        codes[mask] = np.arange(next_code, next_code + count, dtype=np.uint32)
+        next_code += count
+        masked.append(codes)
+    return masked, fractions
+
+
+class TemplateSet:
+    """
+    The template documents of the issuer (its own wording, forms, legal
+    clauses), every shingle of a template is masked in all documents.
+
+    A template is uploaded as a pdf (scanned like the documents) or directly
+    as a scanned json, either way it is ready once <name>.pdf.json exists in
+    the template folder.
+    """
+
+    def __init__(self, folder=TEMPLATE_DIR):
+        self.folder = folder
+        self.lock = threading.Lock()
+        # name -> status of the templates being scanned or failed to scan
+        self.scans = {}
+        self.cached = None
+
+    def path(self, name):
+        name = os.path.basename(name)
+        if not name.lower().endswith('.pdf'):
+            name = os.path.splitext(name)[0] + '.pdf'
+        return os.path.join(self.folder, name)
+
+    def add_json(self, name, raw):
+        """Stores a scanned json as template name, raises ValueError if it isn't one."""
+        try:
+            build_text_document(json.loads(raw), None)
+        except (ValueError, KeyError, TypeError) as e:
+            raise ValueError(f"Not a scanned pdf json: {e}")
+        os.makedirs(self.folder, exist_ok=True)
+        scaned_file = self.path(name) + '.json'
+        with open(scaned_file, 'wb') as f:
+            f.write(raw)
+        prepare_text_document(scaned_file)
+        with self.lock:
+            self.scans.pop(os.path.basename(self.path(name)), None)
+        return os.path.basename(self.path(name))
+
+    def add_pdf(self, pdf_file, scan):
+        """
+        Scans the pdf stored at pdf_file (see path) with scan(pdf_file,
+        scaned_file) in a background thread.
+        """
+        name = os.path.basename(pdf_file)
+        with self.lock:
+            self.scans[name] = {'state': 'progressing', 'message': '正在扫描模板...'}
+
+        def run():
+            try:
+                scan(pdf_file, pdf_file + '.json')
+                status = None
+            except Exception as e:
+                status = {'state': 'error', 'message': str(e)}
+            with self.lock:
+                if status is None:
+                    self.scans.pop(name, None)
+                else:
+                    self.scans[name] = status
+
+        threading.Thread(target=run, daemon=True).start()
+        return name
+
+    def remove(self, name):
+        pdf_file = self.path(name)
+        found = False
+        for path in (pdf_file, pdf_file + '.json', pdf_file + '.text'):
+            if os.path.exists(path):
+                os.remove(path)
+                found = True
+        with self.lock:
+            found = self.scans.pop(os.path.basename(pdf_file), None) is not None or found
+        return found
+
+    def list(self):
+        templates = {}
+        if os.path.isdir(self.folder):
+            for file in sorted(os.listdir(self.folder)):
+                if file.lower().endswith('.pdf.json'):
+                    templates[file[:-len('.json')]] = {'state': 'completed', 'message': '模板可用'}
+        with self.lock:
+            templates.update(self.scans)
+        return [{'name': name, 'status': status} for name, status in sorted(templates.items())]
+
+    def documents(self):
+        return [
+            load_text_document(os.path.join(self.folder, template['name']) + '.json')
+            for template in self.list() if template['status']['state'] == 'completed'
+        ]
+
+    def shingles(self, k=BOILERPLATE_K):
+        """
+        Returns:
+            (the fingerprints of the ready templates, the sorted union of their shingles)
+        """
+        documents = self.documents()
+        fingerprints = tuple(document.fingerprint for document in documents)
+        with self.lock:
+            if self.cached is not None and self.cached[0] == (fingerprints, k):
+                return fingerprints, self.cached[1]
+        shingles = np.zeros(0, dtype=np.uint64)
+        for document in documents:
+            shingles = np.union1d(shingles, shingle_hashes(document.codes, k))
+        with self.lock:
+            self.cached = ((fingerprints, k), shingles)
+        return fingerprints, shingles
+
+
+g_templates = TemplateSet()
+
+
+def template_path(name):
+    return g_templates.path(name)
+
+
+def add_template_json(name, raw):
+    return g_templates.add_json(name, raw)
+
+
+def add_template_pdf(pdf_file, scan):
+    return g_templates.add_pdf(pdf_file, scan)
+
+
+def remove_template(name):
+    return g_templates.remove(name)
+
+
+def list_templates():
+    return g_templates.list()
+
+
+def template_shingles(k=BOILERPLATE_K):
+    return g_templates.shingles(k)
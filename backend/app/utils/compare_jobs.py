@@ -0,0 +1,118 @@
+import threading
+import uuid
+from collections import OrderedDict
+from utils.ssf import find_exact_same_substrings
+from utils.result_view import rank_documents
+from utils.pdf_show import prewarm_documents
+from utils.metrics import gauge, profile_call
+
+# finished jobs hold a full comparison result, only keep the latest ones
+MAX_KEPT_JOBS = 4
+
+STAGE_MESSAGES = {
+    'queued': '等待开始比对...',
+    'loading': '读取扫描结果',
+    'matching': '查找相同片段',
+    'assembling': '生成比对结果',
+}
+
+
+class CompareJob:
+    def __init__(self, incremental, profile=False, fuzzy=False, boilerplate=True):
+        self.job_id = uuid.uuid4().hex
+        self.incremental = incremental
+        self.fuzzy = fuzzy
+        self.boilerplate = boilerplate
+        self.profile = profile
+        # stage timings and cProfile output of a profiled job
+        self.report = None
+        self.stage = 'queued'
+        self.status = {
+            'state': 'pending',
+            'message': STAGE_MESSAGES['queued']
+        }
+        self.progress = 0
+        self.result = None
+
+    def update(self, stage, percent):
+        self.stage = stage
+        self.status = {
+            'state': 'progressing',
+            'message': STAGE_MESSAGES.get(stage, stage)
+        }
+        self.progress = percent
+
+    def run(self):
+        try:
+            options = {
+                'incremental': self.incremental,
+                'progress': self.update,
+                'fuzzy': self.fuzzy,
+                'boilerplate': self.boilerplate
+            }
+            if self.profile:
+                self.result, self.report = profile_call(find_exact_same_substrings, **options)
+            else:
+                self.result = find_exact_same_substrings(**options)
+            # the pages of these documents are going to be rendered next
+            prewarm_documents(rank_documents(self.result))
+            self.stage = 'done'
+            self.status = {
+                'state': 'completed',
+                'message': '比对完成！'
+            }
+            self.progress = 100
+        except Exception as e:
+            self.stage = 'failed'
+            self.status = {
+                'state': 'error',
+                'message': str(e)
+            }
+
+    def get_status(self):
+        return {
+            'job_id': self.job_id,
+            'stage': self.stage,
+            'status': self.status,
+            'progress': self.progress
+        }
+
+
+class CompareJobs:
+    def __init__(self):
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def submit(self, incremental=False, profile=False, fuzzy=False, boilerplate=True):
+        job = CompareJob(incremental, profile, fuzzy, boilerplate)
+        with self.lock:
+            self.jobs[job.job_id] = job
+            finished = [job_id for job_id, j in self.jobs.items() if j.stage in ('done', 'failed')]
+            for job_id in finished[:max(0, len(self.jobs) - MAX_KEPT_JOBS)]:
+                del self.jobs[job_id]
+        threading.Thread(target=job.run, daemon=True).start()
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id, None)
+
+    def count_stages(self):
+        counts = {}
+        with self.lock:
+            for job in self.jobs.values():
+                counts[(job.stage,)] = counts.get((job.stage,), 0) + 1
+        return counts
+
+
+g_compare_jobs = CompareJobs()
+COMPARE_JOBS = gauge('woodpecker_compare_jobs', 'Kept comparison jobs by stage.', ['stage'],
+                     callback=g_compare_jobs.count_stages)
+
+
+def submit_compare(incremental=False, profile=False, fuzzy=False, boilerplate=True):
+    return g_compare_jobs.submit(incremental, profile, fuzzy, boilerplate)
+
+
+def get_compare_job(job_id):
+    return g_compare_jobs.get(job_id)
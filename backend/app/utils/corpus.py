@@ -0,0 +1,51 @@
+import numpy as np
+
+SEPARATOR_BASE = 0x110000
+
+
+class Corpus:
+    """
+    Integer-encoded representation of a list of paragraphs, given as strings
+    or as arrays of utf-32 codes (see TextDocument.codes).
+
+    codes:    uint32 unicode codepoints of all paragraphs, each one followed
+              by its own separator (SEPARATOR_BASE + paragraph index), so no
+              common prefix can run across a paragraph boundary.
+    doc_ids:  int32 paragraph index of every position in codes.
+    offsets:  int64 prefix sums, paragraph i starts at offsets[i] in codes and
+              offsets[-1] == len(codes).
+    lengths:  int64 length of every paragraph (without its separator).
+    """
+
+    def __init__(self, paragraphs):
+        self.paragraphs = paragraphs
+        n = len(paragraphs)
+        self.lengths = np.fromiter((len(p) for p in paragraphs), dtype=np.int64, count=n)
+        self.offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(self.lengths + 1, out=self.offsets[1:])
+
+        self.codes = np.empty(self.offsets[-1], dtype=np.uint32)
+        for i, para in enumerate(paragraphs):
+            start, end = self.offsets[i], self.offsets[i + 1] - 1
+            if isinstance(para, str):
+                para = np.frombuffer(para.encode('utf-32-le', 'surrogatepass'), dtype=np.uint32)
+            self.codes[start:end] = para
+        self.codes[self.offsets[1:] - 1] = SEPARATOR_BASE + np.arange(n, dtype=np.uint32)
+        self.doc_ids = np.repeat(np.arange(n, dtype=np.int32), self.lengths + 1)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def locate(self, positions):
+        """
+        Maps corpus positions back to (paragraph indices, start indices) in batch.
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        docs = np.searchsorted(self.offsets, positions, side='right') - 1
+        return docs, positions - self.offsets[docs]
+
+    def segment(self, doc, start, length):
+        segment = self.paragraphs[doc][start:start + length]
+        if isinstance(segment, str):
+            return segment
+        return np.asarray(segment, dtype=np.uint32).tobytes().decode('utf-32-le', 'surrogatepass')
@@ -0,0 +1,241 @@
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+from utils.winnowing import winnow
+from utils.find_position import BlockIndex
+
+TEXT_MAGIC = b'WPTEXT'
+# bump whenever the layout of the .text file changes
+TEXT_VERSION = 3
+TEXT_ALIGN = 64
+# name, dtype and the trailing shape of the arrays stored in a .text file
+TEXT_ARRAYS = (
+    ('codes', np.uint32, ()),
+    ('offsets', np.int64, ()),
+    ('pages', np.int32, ()),
+    ('bboxes', np.float64, (4,)),
+    ('winnowing', np.uint64, ()),
+)
+
+
+def get_text_path(scaned_file):
+    """The compact text file next to a scanned .pdf.json."""
+    if scaned_file.endswith('.json'):
+        return scaned_file[:-len('.json')] + '.text'
+    return scaned_file + '.text'
+
+
+class TextDocument:
+    """
+    The part of a scanned .pdf.json the comparison needs: the concatenated
+    text of all text blocks as utf-32 codes, a block table (start offset in
+    the text, page, bbox), the winnowing fingerprints of the text and the
+    sha1 of the text (fingerprint) and of the json (digest).
+
+    The arrays are usually memory-mapped from the .text file.
+    """
+
+    def __init__(self, codes, offsets, pages, bboxes, winnowing, fingerprint, digest):
+        self.codes = codes
+        self.offsets = offsets
+        self.pages = pages
+        self.bboxes = bboxes
+        self.winnowing = winnowing
+        self.fingerprint = fingerprint
+        self.digest = digest
+        self._text = None
+        self._block_index = None
+        self._blocks = {}
+
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = np.asarray(self.codes).tobytes().decode('utf-32-le', 'surrogatepass')
+        return self._text
+
+    @property
+    def block_index(self):
+        if self._block_index is None:
+            self._block_index = BlockIndex(self.offsets)
+        return self._block_index
+
+    def block(self, index):
+        """The text block `index` in the shape of the KBPort json."""
+        block = self._blocks.get(index, None)
+        if block is None:
+            start, end = int(self.offsets[index]), int(self.offsets[index + 1])
+            block = self._blocks[index] = {
+                'type': 'text',
+                'text': self.text[start:end],
+                'page': int(self.pages[index]),
+                'bbox': self.bboxes[index].tolist()
+            }
+        return block
+
+    def cover(self, start, length):
+        """
+        The blocks covered by text[start:start + length], each one as its
+        page, bbox and the range of characters inside the block.
+
+        Returns:
+            (index of the first block, list of the covered blocks)
+        """
+        spans = self.block_index.cover(start, length)
+        return spans[0][0], [
+            {
+                'page': int(self.pages[index]),
+                'bbox': self.bboxes[index].tolist(),
+                'start': begin,
+                'end': end
+            }
+            for index, begin, end in spans
+        ]
+
+
+def build_text_document(json_repr, digest):
+    parts = []
+    offsets = [0]
+    pages = []
+    bboxes = []
+    for text_block in json_repr['metadata']['text_block']:
+        if text_block['type'] == 'text':
+            parts.append(text_block['text'])
+            offsets.append(offsets[-1] + len(text_block['text']))
+            pages.append(text_block.get('page', 0))
+            bboxes.append(text_block.get('bbox', None) or (0, 0, 0, 0))
+    text = ''.join(parts)
+    document = TextDocument(
+        np.frombuffer(text.encode('utf-32-le', 'surrogatepass'), dtype=np.uint32),
+        np.array(offsets, dtype=np.int64),
+        np.array(pages, dtype=np.int32),
+        np.array(bboxes, dtype=np.float64).reshape(-1, 4),
+        winnow(text),
+        hashlib.sha1(text.encode('utf-8', 'surrogatepass')).hexdigest(),
+        digest
+    )
+    document._text = text
+    return document
+
+
+def write_text_file(path, document, stamp):
+    """
+    Writes document to path: the magic, the length of a json header, the
+    header (stamp and hashes of the source json, array shapes) and the arrays,
+    each one aligned to TEXT_ALIGN bytes so it can be memory-mapped.
+    """
+    arrays = []
+    position = 0
+    for name, dtype, _ in TEXT_ARRAYS:
+        array = np.ascontiguousarray(getattr(document, name), dtype=dtype)
+        arrays.append((name, array))
+        position += -position % TEXT_ALIGN + array.nbytes
+    header = {
+        'version': TEXT_VERSION,
+        'stamp': list(stamp),
+        'digest': document.digest,
+        'fingerprint': document.fingerprint,
+        'shapes': {name: list(array.shape) for name, array in arrays}
+    }
+    header = json.dumps(header).encode('utf-8')
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(TEXT_MAGIC + len(header).to_bytes(4, 'little') + header)
+        for _, array in arrays:
+            f.write(b'\0' * (-f.tell() % TEXT_ALIGN))
+            f.write(array.tobytes())
+    os.replace(tmp_path, path)
+
+
+def read_text_file(path):
+    """
+    Returns:
+        (stamp of the source json, TextDocument with memory-mapped arrays) or
+        None if path is missing or not a current .text file.
+    """
+    try:
+        with open(path, 'rb') as f:
+            if f.read(len(TEXT_MAGIC)) != TEXT_MAGIC:
+                return None
+            header_size = int.from_bytes(f.read(4), 'little')
+            header = json.loads(f.read(header_size))
+            position = f.tell()
+    except (OSError, ValueError):
+        return None
+    if header.get('version') != TEXT_VERSION:
+        return None
+    arrays = {}
+    for name, dtype, _ in TEXT_ARRAYS:
+        shape = tuple(header['shapes'][name])
+        position += -position % TEXT_ALIGN
+        if 0 in shape:
+            arrays[name] = np.zeros(shape, dtype=dtype)
+        else:
+            arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=position, shape=shape)
+        position += int(np.prod(shape)) * np.dtype(dtype).itemsize
+    document = TextDocument(fingerprint=header['fingerprint'], digest=header['digest'], **arrays)
+    return tuple(header['stamp']), document
+
+
+class TextCache:
+    """
+    Two level (memory, .text file) cache of TextDocument objects.
+
+    A .text file is reused as long as the mtime and size of the scanned json
+    are unchanged. If they changed, the json is hashed and only re-parsed if
+    its sha1 differs from the one stored in the .text file.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def load(self, scaned_file):
+        stat = os.stat(scaned_file)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            entry = self.entries.get(scaned_file, None)
+        if entry is None:
+            entry = read_text_file(get_text_path(scaned_file))
+        if entry is None or entry[0] != stamp:
+            entry = self.update(scaned_file, stamp, entry)
+        with self.lock:
+            self.entries[scaned_file] = entry
+        return entry[1]
+
+    @staticmethod
+    def update(scaned_file, stamp, entry=None):
+        with open(scaned_file, 'rb') as f:
+            raw = f.read()
+        digest = hashlib.sha1(raw).hexdigest()
+        if entry is not None and entry[1].digest == digest:
+            document = entry[1]
+        else:
+            document = build_text_document(json.loads(raw), digest)
+        write_text_file(get_text_path(scaned_file), document, stamp)
+        return stamp, document
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+
+
+g_text_cache = TextCache()
+
+
+def load_text_document(scaned_file):
+    return g_text_cache.load(scaned_file)
+
+
+def prepare_text_document(scaned_file):
+    """Writes the .text file of a freshly scanned json (unless it is current)."""
+    stat = os.stat(scaned_file)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    entry = read_text_file(get_text_path(scaned_file))
+    if entry is None or entry[0] != stamp:
+        TextCache.update(scaned_file, stamp, entry)
+
+
+def clear_text_cache():
+    g_text_cache.clear()
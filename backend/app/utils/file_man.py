@@ -2,9 +2,13 @@ import zipfile
 import glob
 import os
 import shutil
-from io import BytesIO
+import threading
+import uuid
+import hashlib
 
 UPLOAD_DIR = "uploads"
+INCOMING_DIR = os.path.join(UPLOAD_DIR, ".incoming")
+COPY_CHUNK_SIZE = 1024 * 1024
 
 def clear_folder(folder_path):
     if not os.path.exists(folder_path):
@@ -19,17 +23,113 @@ def clear_folder(folder_path):
             shutil.rmtree(item_path)
 
 
-def unzip_file(zip_file_bytes, dest_path):
+class UnzipJob:
+    def __init__(self, zip_path, dest_path, on_extracted=None):
+        self.upload_id = uuid.uuid4().hex
+        self.zip_path = zip_path
+        self.dest_path = dest_path
+        self.on_extracted = on_extracted
+        self.status = {
+            'state': 'pending',
+            'message': '等待解压...'
+        }
+        self.progress = 0
+        self.extracted_files = []
+
+    def run(self):
+        try:
+            def report(done, total):
+                self.status = {
+                    'state': 'progressing',
+                    'message': f'正在解压 [{done} / {total}]'
+                }
+                self.progress = int(done / total * 100) if total > 0 else 100
+            extracted = unzip_file(self.zip_path, self.dest_path, report)
+            self.extracted_files = [full_path for full_path, _ in extracted]
+            pdf_files = [
+                (full_path, get_scaned_path(full_path), digest)
+                for full_path, digest in extracted if full_path.lower().endswith('.pdf')
+            ]
+            if self.on_extracted is not None:
+                self.on_extracted(pdf_files)
+            self.status = {
+                'state': 'completed',
+                'message': f'解压完成, 发现{len(pdf_files)}个PDF文件!'
+            }
+            self.progress = 100
+        except Exception as e:
+            self.status = {
+                'state': 'error',
+                'message': str(e)
+            }
+        finally:
+            os.remove(self.zip_path)
+
+    def get_status(self):
+        return {
+            'upload_id': self.upload_id,
+            'status': self.status,
+            'progress': self.progress,
+            'files': len(self.extracted_files)
+        }
+
+
+unzip_jobs = {}
+
+
+def start_unzip(zip_path, dest_path, on_extracted=None):
+    """
+    Extracts zip_path into dest_path in a worker thread, on_extracted is called
+    with the (pdf file, scanned file, sha256) tuples that were extracted.
+    """
+    job = UnzipJob(zip_path, dest_path, on_extracted)
+    unzip_jobs[job.upload_id] = job
+    threading.Thread(target=job.run, daemon=True).start()
+    return job
+
+
+def get_unzip_job(upload_id):
+    return unzip_jobs.get(upload_id, None)
+
+
+def unzip_file(zip_path, dest_path, progress=None):
+    """
+    Extracts a zip archive member by member, each one is copied in
+    COPY_CHUNK_SIZE pieces, so memory use doesn't depend on the archive size.
+    The sha256 of every member is computed on the way.
+
+    Returns:
+        A list of (path, sha256 hex digest) of the extracted files.
+    """
     extracted_files = []
-    with BytesIO(zip_file_bytes) as zip_stream:
-        with zipfile.ZipFile(zip_stream) as zip_file:
-            zip_contents = zip_file.namelist()
-            zip_file.extractall(path=dest_path)
+    dest_root = os.path.realpath(dest_path)
+    with zipfile.ZipFile(zip_path) as zip_file:
+        members = [member for member in zip_file.infolist() if not member.is_dir()]
+        total = sum(member.file_size for member in members)
+        done = 0
+        for member in members:
+            full_path = os.path.normpath(os.path.join(dest_path, member.filename))
+            # refuse members escaping the destination ("../", absolute paths)
+            if os.path.commonpath([dest_root, os.path.realpath(full_path)]) != dest_root:
+                raise ValueError(f"Illegal path in zip file: {member.filename}")
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            digest = hashlib.sha256()
+            with zip_file.open(member) as source, open(full_path, 'wb') as target:
+                while True:
+                    chunk = source.read(COPY_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    target.write(chunk)
+                    done += len(chunk)
+                    if progress is not None:
+                        progress(done, total)
+            extracted_files.append((full_path, digest.hexdigest()))
+    return extracted_files
+
 
-            for item in zip_contents:
-                full_path = os.path.join(dest_path, item)
-                if not item.endswith('/'):
-                    extracted_files.append(full_path)
+def get_scaned_path(full_path):
+    return full_path.replace(".pdf", ".pdf.json")
 
 
 def collect_pdf_files():
@@ -38,6 +138,6 @@ def collect_pdf_files():
         for file in files:
             if file.lower().endswith('.pdf'):
                 full_path = os.path.join(root, file)
-                scaned_path = full_path.replace(".pdf", ".pdf.json")
+                scaned_path = get_scaned_path(full_path)
                 pdf_files.append((full_path, scaned_path))
     return pdf_files
\ No newline at end of file
@@ -1,41 +1,42 @@
-def find_index_by_value(arr, target):
-    # Create list of (value, index) pairs
-    indexed_arr = list(enumerate(arr))
-    # Sort by value
-    indexed_arr.sort(key=lambda x: x[1])
-
-    # Handle edge cases
-    if not arr or target < indexed_arr[0][1]:
-        return -1
-    if target > indexed_arr[-1][1]:
-        return indexed_arr[-1][1]
-
-    # Binary search
-    left, right = 0, len(arr) - 1
-    while left <= right:
-        mid = (left + right) // 2
-        curr_val = indexed_arr[mid][1]
-
-        # Check if target is between current and next value
-        if mid < len(arr) - 1 and curr_val <= target < indexed_arr[mid + 1][1]:
-            return indexed_arr[mid][1]
-        # Check if target equals current value
-        elif curr_val == target:
-            return indexed_arr[mid][1]
-        elif curr_val < target:
-            left = mid + 1
-        else:
-            right = mid - 1
-
-    # If we reach here, target is between the last checked values
-    return indexed_arr[right][1]
+from bisect import bisect_right
+
+
+class BlockIndex:
+    """
+    Maps text offsets to the text blocks they fall into.
+
+    Built once from the sorted block start offsets of a document, offsets[i]
+    is the start of block i and offsets[-1] the length of the text.
+    """
+
+    def __init__(self, offsets):
+        self.offsets = [int(offset) for offset in offsets]
+
+    def find(self, position):
+        """The index of the block holding `position`, -1 if it is before the text."""
+        return bisect_right(self.offsets, position, hi=len(self.offsets) - 1) - 1
+
+    def cover(self, start, length):
+        """
+        Every block covered by the text range [start, start + length).
+
+        Returns:
+            A list of (block index, begin, end) with begin and end relative to
+            the start of the block.
+        """
+        end = start + length
+        spans = []
+        index = max(self.find(start), 0)
+        while index < len(self.offsets) - 1 and self.offsets[index] < end:
+            block_start, block_end = self.offsets[index], self.offsets[index + 1]
+            if block_end > block_start:
+                spans.append((index, max(start, block_start) - block_start, min(end, block_end) - block_start))
+            index += 1
+        return spans
 
 
 # Example usage
 if __name__ == "__main__":
-    arr = [4, 0, 9, 10]
-    test_values = [7, 0, 11, -1, 8, 3]
-
-    for val in test_values:
-        result = find_index_by_value(arr, val)
-        print(f"Value {val} -> Index {result}")
\ No newline at end of file
+    index = BlockIndex([0, 4, 9, 9, 10, 12])
+    for start, length in [(0, 2), (3, 3), (7, 4), (11, 1)]:
+        print(f"[{start}, {start + length}) -> {index.cover(start, length)}")
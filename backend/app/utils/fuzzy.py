@@ -0,0 +1,225 @@
+from collections import defaultdict
+from utils.corpus import Corpus
+from utils.suffix_array import build_suffix_array, build_lcp_array, find_maximal_repeats
+
+# exact repeats of this length seed the alignments
+FUZZY_K = 8
+FUZZY_MIN_LEN = 20
+FUZZY_MIN_SIMILARITY = 0.8
+# anchors further apart than this (in either document) are not chained
+FUZZY_MAX_GAP = 24
+# the diagonal may drift by this much between two chained anchors
+FUZZY_BAND = 8
+# repeats in more documents than this are template text, not anchors
+FUZZY_MAX_OCCURRENCES = 64
+EXTEND_XDROP = 6
+
+
+def banded_edit_distance(a, b, band):
+    """
+    Levenshtein distance of the sequences a and b, only cells with
+    |j - i| <= band (widened to reach the corner) are computed.
+    """
+    n, m = len(a), len(b)
+    band = max(band, abs(n - m))
+    inf = n + m + 1
+    previous = {j: j for j in range(0, min(m, band) + 1)}
+    for i in range(1, n + 1):
+        current = {}
+        for j in range(max(0, i - band), min(m, i + band) + 1):
+            if j == 0:
+                current[j] = i
+                continue
+            cost = previous.get(j - 1, inf) + (a[i - 1] != b[j - 1])
+            cost = min(cost, previous.get(j, inf) + 1, current.get(j - 1, inf) + 1)
+            current[j] = cost
+        previous = current
+    return previous.get(m, inf)
+
+
+def extend_alignment(a, b, band=FUZZY_BAND, xdrop=EXTEND_XDROP):
+    """
+    Extends an alignment from the start of a and b, +1 for a match and -1 for
+    any edit, as long as the score stays within xdrop of the best one.
+
+    Returns:
+        The lengths (i, j) of the best scoring prefixes of a and b.
+    """
+    best, best_i, best_j = 0, 0, 0
+    previous = {0: 0}
+    for j in range(1, min(len(b), band) + 1):
+        previous[j] = -j
+    for i in range(1, len(a) + 1):
+        current = {}
+        for j in range(max(0, i - band), min(len(b), i + band) + 1):
+            scores = []
+            if j in previous:
+                scores.append(previous[j] - 1)
+            if j - 1 in current:
+                scores.append(current[j - 1] - 1)
+            if j >= 1 and j - 1 in previous:
+                scores.append(previous[j - 1] + (1 if a[i - 1] == b[j - 1] else -1))
+            if not scores:
+                continue
+            score = max(scores)
+            if score >= best - xdrop:
+                current[j] = score
+                if score > best:
+                    best, best_i, best_j = score, i, j
+        if not current:
+            break
+        previous = current
+    return best_i, best_j
+
+
+def collect_anchors(corpus, suffix_array, repeats, max_occurrences, focus=None):
+    """
+    Every pair of occurrences of a repeat in two different documents.
+
+    Returns:
+        {(doc a, doc b): list of (start in a, start in b, length)} with a < b.
+    """
+    anchors = defaultdict(list)
+    for length, lb, rb in repeats:
+        if rb - lb + 1 > max_occurrences:
+            continue
+        docs, starts = corpus.locate(suffix_array[lb:rb + 1])
+        places = sorted(zip(docs.tolist(), starts.tolist()))
+        for x in range(len(places)):
+            doc_a, start_a = places[x]
+            for doc_b, start_b in places[x + 1:]:
+                if doc_a == doc_b:
+                    continue
+                if focus is not None and doc_a not in focus and doc_b not in focus:
+                    continue
+                anchors[(doc_a, doc_b)].append((start_a, start_b, length))
+    return anchors
+
+
+def chain_anchors(anchors, max_gap=FUZZY_MAX_GAP, band=FUZZY_BAND):
+    """
+    Greedily chains the anchors of a document pair: an anchor continues the
+    chain whose end is at most max_gap behind it in both documents, with a
+    diagonal (start in b - start in a) at most band away.
+
+    Returns:
+        A list of chains, each a list of (start in a, start in b, length)
+        ordered along both documents.
+    """
+    chains = []
+    active = []
+    # longest first at the same start, so the shorter anchors are contained
+    for start_a, start_b, length in sorted(anchors, key=lambda anchor: (anchor[0], anchor[1], -anchor[2])):
+        # the anchors come by start in a, chains ending too far behind are done
+        active = [chain for chain in active if start_a - (chain[-1][0] + chain[-1][2]) <= max_gap]
+        target = None
+        for chain in reversed(active):
+            last_a, last_b, last_length = chain[-1]
+            end_a, end_b = last_a + last_length, last_b + last_length
+            if start_b - start_a == last_b - last_a and start_a + length <= end_a:
+                target, length = chain, 0
+                break
+            if start_b <= last_b or start_b - end_b > max_gap:
+                continue
+            if abs((start_b - start_a) - (last_b - last_a)) > band:
+                continue
+            target = chain
+            break
+        if target is None:
+            chain = [(start_a, start_b, length)]
+            chains.append(chain)
+            active.append(chain)
+        elif length:
+            target.append((start_a, start_b, length))
+    return chains
+
+
+def align_chain(text_a, text_b, chain, band=FUZZY_BAND):
+    """
+    Aligns a chain: the gaps between its anchors with a banded edit distance,
+    the ends extended while they still align.
+
+    Returns:
+        (start in a, length in a, start in b, length in b, edit distance)
+    """
+    first_a, first_b, first_length = chain[0]
+    edits = 0
+    end_a, end_b = first_a + first_length, first_b + first_length
+    for start_a, start_b, length in chain[1:]:
+        # overlapping anchors on different diagonals, skip the overlap
+        overlap = max(end_a - start_a, end_b - start_b, 0)
+        if overlap >= length:
+            continue
+        start_a, start_b, length = start_a + overlap, start_b + overlap, length - overlap
+        edits += banded_edit_distance(text_a[end_a:start_a], text_b[end_b:start_b], band)
+        end_a, end_b = start_a + length, start_b + length
+
+    # extend to the left (on the reversed texts) and to the right
+    left_a = text_a[max(0, first_a - FUZZY_MAX_GAP * 2):first_a][::-1]
+    left_b = text_b[max(0, first_b - FUZZY_MAX_GAP * 2):first_b][::-1]
+    i, j = extend_alignment(left_a, left_b, band)
+    if i or j:
+        edits += banded_edit_distance(left_a[:i], left_b[:j], band)
+    first_a, first_b = first_a - i, first_b - j
+    right_a = text_a[end_a:end_a + FUZZY_MAX_GAP * 2]
+    right_b = text_b[end_b:end_b + FUZZY_MAX_GAP * 2]
+    i, j = extend_alignment(right_a, right_b, band)
+    if i or j:
+        edits += banded_edit_distance(right_a[:i], right_b[:j], band)
+    end_a, end_b = end_a + i, end_b + j
+    return first_a, end_a - first_a, first_b, end_b - first_b, edits
+
+
+def find_similar_segments(paragraphs, k=FUZZY_K, min_len=FUZZY_MIN_LEN, min_similarity=FUZZY_MIN_SIMILARITY,
+                          max_occurrences=FUZZY_MAX_OCCURRENCES, focus=None):
+    """
+    Finds lightly edited passages shared by two paragraphs (anchor and extend).
+
+    The exact repeats of at least k symbols (found with the suffix array, as in
+    find_exact_same_segments) are the anchors. The anchors of a pair of
+    paragraphs are chained along a diagonal band, the gaps between them are
+    aligned with a banded edit distance and the chain ends are extended, so the
+    cost stays close to linear in the length of the matched passages.
+
+    Args:
+        paragraphs: A list of paragraphs, as strings or arrays of utf-32 codes.
+        k: The minimum length of an anchor.
+        min_len: The minimum length of a reported passage (in both paragraphs).
+        min_similarity: The minimum of 1 - edit distance / longer passage length.
+        max_occurrences: Repeats with more occurrences don't make anchors.
+        focus: Optional collection of paragraph indices, only pairs with one of
+            them are aligned.
+
+    Returns:
+        A list of (paragraph a, start in a, length in a, paragraph b, start in
+        b, length in b, similarity) with a < b.
+    """
+    if len(paragraphs) < 2:
+        return []
+    corpus = Corpus(paragraphs)
+    suffix_array = build_suffix_array(corpus.codes)
+    lcp_array = build_lcp_array(corpus.codes, suffix_array)
+    repeats = find_maximal_repeats(corpus.codes, suffix_array, lcp_array, k, corpus.doc_ids, max_occurrences)
+    focus = None if focus is None else set(focus)
+    anchors = collect_anchors(corpus, suffix_array, repeats, max_occurrences, focus)
+
+    # the alignments index single symbols, lists are much faster at that than
+    # arrays, every paragraph is converted once
+    texts = {}
+
+    def text_of(doc):
+        if doc not in texts:
+            texts[doc] = corpus.codes[corpus.offsets[doc]:corpus.offsets[doc + 1] - 1].tolist()
+        return texts[doc]
+
+    passages = []
+    for (doc_a, doc_b), pair_anchors in sorted(anchors.items()):
+        text_a, text_b = text_of(doc_a), text_of(doc_b)
+        for chain in chain_anchors(pair_anchors):
+            start_a, length_a, start_b, length_b, edits = align_chain(text_a, text_b, chain)
+            if min(length_a, length_b) < min_len:
+                continue
+            similarity = 1 - edits / max(length_a, length_b)
+            if similarity >= min_similarity:
+                passages.append((doc_a, start_a, length_a, doc_b, start_b, length_b, similarity))
+    return passages
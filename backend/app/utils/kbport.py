@@ -1,6 +1,15 @@
 import requests
 import os
 import time
+import threading
+from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
+from utils.metrics import histogram, counter
+
+KBPORT_REQUEST_SECONDS = histogram('woodpecker_kbport_request_seconds',
+                                   'Latency of the KBPort requests (without waiting for a slot).', ['endpoint'])
+KBPORT_REQUESTS = counter('woodpecker_kbport_requests_total', 'KBPort requests by response status.',
+                          ['endpoint', 'status'])
 
 
 def get_folder_path(absolute_path, prefix_to_remove):
@@ -27,12 +36,46 @@ class SubmittedJob:
 
 
 class KBPort:
-    def __init__(self, username: str, token: str, url: str):
+    def __init__(self, username: str, token: str, url: str, max_concurrency: int = 8):
         self.url = url
         if not self.url.endswith("/"):
             self.url += "/"
         self.username = username
         self.token = token
+        # one keep-alive connection pool shared by all threads, at most
+        # max_concurrency requests are in flight at the same time
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+
+    def request(self, method: str, endpoint: str, **kwargs):
+        with self.slots:
+            status = 'error'
+            try:
+                with KBPORT_REQUEST_SECONDS.time(endpoint=endpoint):
+                    response = self.session.request(method, self.url + endpoint, **kwargs)
+                status = response.status_code
+                return response
+            finally:
+                KBPORT_REQUESTS.inc(endpoint=endpoint, status=status)
+
+    @contextmanager
+    def stream(self, method: str, endpoint: str, **kwargs):
+        """
+        request() with a streamed response: the slot and the latency timer are
+        held until the with block has read the body, not just the headers.
+        """
+        with self.slots:
+            status = 'error'
+            try:
+                with KBPORT_REQUEST_SECONDS.time(endpoint=endpoint):
+                    with self.session.request(method, self.url + endpoint, stream=True, **kwargs) as response:
+                        status = response.status_code
+                        yield response
+            finally:
+                KBPORT_REQUESTS.inc(endpoint=endpoint, status=status)
 
     def single_parse_job(self, file_path, result_dir=''):
         if not os.path.isfile(file_path):
@@ -42,7 +85,7 @@ class KBPort:
         with open(file_path, 'rb') as f:
             files = {'file': f}
             data = {'username': self.username, 'token': self.token, 'folder': result_dir}
-            response = requests.post(self.url + 'pdf_parse', files=files, data=data)
+            response = self.request('POST', 'pdf_parse', files=files, data=data)
             if response.status_code == 200:
                 return SubmittedJob(os.path.join(result_dir, os.path.basename(file_path)), True)
             elif response.status_code == 500:
@@ -75,7 +118,7 @@ class KBPort:
 
     def get_job_status(self, result_path: str):
         data = {'file_path': result_path, 'username': self.username, 'token': self.token}
-        response = requests.get(self.url + 'status', data=data)
+        response = self.request('GET', 'status', data=data)
         if response.status_code == 200:
             job_status = {}
             job_status['status'] = response.json()['status']
@@ -89,7 +132,7 @@ class KBPort:
     def get_job_result(self, result_path: str):
         headers = {'Accept-Encoding': 'gzip'}
         data = {'file_path': result_path, 'username': self.username, 'token': self.token}
-        response = requests.get(self.url + 'get_result', headers=headers, data=data)
+        response = self.request('GET', 'get_result', headers=headers, data=data)
         if response.status_code == 200:
             return response.json()
         elif response.status_code == 500:
@@ -97,6 +140,28 @@ class KBPort:
         else:
             raise Exception(response.json()['message'])
 
+    def download_job_result(self, result_path: str, target_path: str, chunk_size=1024 * 1024):
+        """
+        Streams the result of a finished job into target_path, gzip is
+        decompressed on the fly. The file only appears once it is complete.
+        """
+        headers = {'Accept-Encoding': 'gzip'}
+        data = {'file_path': result_path, 'username': self.username, 'token': self.token}
+        with self.stream('GET', 'get_result', headers=headers, data=data) as response:
+            if response.status_code == 500:
+                raise Exception(response.json()['error'])
+            elif response.status_code != 200:
+                raise Exception(response.json()['message'])
+            tmp_path = f"{target_path}.{threading.get_ident()}.tmp"
+            try:
+                with open(tmp_path, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size):
+                        f.write(chunk)
+                os.replace(tmp_path, target_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
     def polling_job_result(self, result_path: str, time_out=7200):
         start_time = time.time()
         started = False
@@ -123,7 +188,7 @@ class KBPort:
     def get_all_status(self):
         all_status = []
         data = {'username': self.username, 'token': self.token}
-        response = requests.get(self.url + 'all_status', data=data)
+        response = self.request('GET', 'all_status', data=data)
         if response.status_code == 200:
             status_json = response.json()
             for file, file_stat in status_json.items():
@@ -140,7 +205,7 @@ class KBPort:
 
     def delete_result(self, result_path: str):
         data = {'file_path': result_path, 'username': self.username, 'token': self.token}
-        response = requests.delete(self.url + 'delete', data=data)
+        response = self.request('DELETE', 'delete', data=data)
         if response.status_code == 200:
             return True
         elif response.status_code == 500:
@@ -150,7 +215,7 @@ class KBPort:
 
     def cancel_job(self):
         data = {'username': self.username, 'token': self.token}
-        response = requests.post(self.url + 'cancel_parse', data=data)
+        response = self.request('POST', 'cancel_parse', data=data)
         if response.status_code == 200:
             return True
         elif response.status_code == 500:
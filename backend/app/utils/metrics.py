@@ -0,0 +1,211 @@
+import io
+import time
+import cProfile
+import pstats
+import threading
+from contextlib import contextmanager
+
+# seconds, from a cached page render up to a large comparison
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+_recording = threading.local()
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = [
+        '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels
+    ]
+    return '{' + ','.join(escaped) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} takes the labels {self.labels}, got {tuple(labels)}")
+        return tuple((name, labels[name]) for name in self.labels)
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, key, value) for key, value in self.values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labels=(), callback=None):
+        """callback, if given, returns {label values tuple: value} at every scrape."""
+        super().__init__(name, documentation, labels)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def samples(self):
+        if self.callback is None:
+            return super().samples()
+        return [(self.name, tuple(zip(self.labels, key)), value) for key, value in self.callback().items()]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value)
+        recorder = getattr(_recording, 'observations', None)
+        if recorder is not None:
+            recorder.append((self.name, labels, value))
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (counts, total) in self.values.items():
+                for bound, count in zip(self.buckets, counts):
+                    samples.append((self.name + '_bucket', key + (('le', format_value(bound)),), count))
+                samples.append((self.name + '_count', key, counts[-1]))
+                samples.append((self.name + '_sum', key, total))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def get(self, name):
+        return self.metrics.get(name, None)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+g_registry = Registry()
+
+
+def counter(name, documentation, labels=()):
+    return g_registry.register(Counter(name, documentation, labels))
+
+
+def gauge(name, documentation, labels=(), callback=None):
+    return g_registry.register(Gauge(name, documentation, labels, callback))
+
+
+def histogram(name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+    return g_registry.register(Histogram(name, documentation, labels, buckets))
+
+
+@contextmanager
+def record_observations():
+    """
+    Collects the histogram observations made by the current thread, as a list
+    of (metric name, labels, value). Nested recordings both get them.
+    """
+    outer = getattr(_recording, 'observations', None)
+    observations = []
+    _recording.observations = observations
+    try:
+        yield observations
+    finally:
+        _recording.observations = outer
+        if outer is not None:
+            outer.extend(observations)
+
+
+def replay_observations(observations):
+    """Applies observations recorded in another process to this one."""
+    for name, labels, value in observations:
+        metric = g_registry.get(name)
+        if metric is not None:
+            metric.observe(value, **labels)
+
+
+def render_metrics():
+    return g_registry.render()
+
+
+def profile_call(func, *args, **kwargs):
+    """
+    Runs func under cProfile, recording its histogram observations too.
+
+    Returns:
+        (result of func, report) where the report has the seconds spent per
+        observed (metric, labels) and the 40 most expensive functions of the
+        calling thread (work done in worker processes only shows up in the
+        observations).
+    """
+    profiler = cProfile.Profile()
+    with record_observations() as observations:
+        profiler.enable()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            profiler.disable()
+    timings = {}
+    for name, labels, value in observations:
+        key = name + format_labels(sorted(labels.items()))
+        timings[key] = timings.get(key, 0.0) + value
+    stream = io.StringIO()
+    pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(40)
+    return result, {'timings': timings, 'profile': stream.getvalue()}
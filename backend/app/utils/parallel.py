@@ -0,0 +1,110 @@
+import os
+import tempfile
+import threading
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+from utils.corpus import Corpus
+from utils.metrics import record_observations, replay_observations
+
+COMPARE_WORKERS = int(os.environ.get("COMPARE_WORKERS", os.cpu_count() or 1))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # spawn, the backend process runs threads (scan loop, server)
+            _executor = ProcessPoolExecutor(max_workers=COMPARE_WORKERS, mp_context=get_context("spawn"))
+        return _executor
+
+
+def pack_shards(jobs, sizes, shard_count):
+    """
+    Distributes jobs over shard_count shards, largest job first onto the
+    currently smallest shard.
+
+    Args:
+        jobs: A list of (document indices, kwargs) tuples.
+        sizes: The text length of every document.
+        shard_count: The number of shards.
+
+    Returns:
+        A list of non-empty shards, each a list of (job index, document indices, kwargs).
+    """
+    shards = [[] for _ in range(shard_count)]
+    loads = [0] * shard_count
+    weights = [sum(sizes[i] for i in docs) for docs, _ in jobs]
+    for job_index in sorted(range(len(jobs)), key=lambda j: (-weights[j], j)):
+        target = min(range(shard_count), key=lambda s: (loads[s], s))
+        docs, kwargs = jobs[job_index]
+        shards[target].append((job_index, docs, kwargs))
+        loads[target] += weights[job_index]
+    return [shard for shard in shards if shard]
+
+
+def _run_shard(func, codes_path, offsets, shard):
+    codes = np.load(codes_path, mmap_mode='r')
+    output = []
+    # the metrics of this process are lost, they travel back with the results
+    with record_observations() as observations:
+        for job_index, docs, kwargs in shard:
+            paragraphs = [codes[offsets[i]:offsets[i + 1] - 1] for i in docs]
+            output.append((job_index, func(paragraphs, **kwargs)))
+    return output, observations
+
+
+def run_sharded(func, paragraphs, jobs, workers=COMPARE_WORKERS, progress=None):
+    """
+    Runs func([paragraphs[i] for i in docs], **kwargs) for every job in
+    `jobs`, spread over a process pool.
+
+    The corpus is written once to a temporary .npy file that the workers
+    memory-map, so only document indices travel to the workers. The results
+    come back in job order, whatever shard or worker computed them.
+
+    Args:
+        func: A module level function taking a list of paragraphs.
+        paragraphs: All document texts.
+        jobs: A list of (document indices, kwargs) tuples.
+        workers: The number of worker processes, with 1 (or a single job)
+            everything runs in the calling process.
+        progress: Optional progress(done, total) callback, called whenever a
+            job is finished.
+
+    Returns:
+        A list with the result of every job.
+    """
+    if workers <= 1 or len(jobs) <= 1:
+        results = []
+        for docs, kwargs in jobs:
+            results.append(func([paragraphs[i] for i in docs], **kwargs))
+            if progress is not None:
+                progress(len(results), len(jobs))
+        return results
+
+    corpus = Corpus(paragraphs)
+    fd, codes_path = tempfile.mkstemp(suffix='.npy')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, corpus.codes)
+        offsets = corpus.offsets.tolist()
+        shards = pack_shards(jobs, corpus.lengths.tolist(), min(workers, len(jobs)) * 4)
+        executor = get_executor()
+        futures = [executor.submit(_run_shard, func, codes_path, offsets, shard) for shard in shards]
+        results = [None] * len(jobs)
+        done = 0
+        for future in as_completed(futures):
+            output, observations = future.result()
+            replay_observations(observations)
+            for job_index, result in output:
+                results[job_index] = result
+                done += 1
+            if progress is not None:
+                progress(done, len(jobs))
+        return results
+    finally:
+        os.remove(codes_path)
@@ -1,91 +1,417 @@
 import pypdfium2 as pdfium
 import os
 import io
+import zlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from multiprocessing import get_context
 from PIL import Image, ImageDraw, ImageFont
 from typing import Annotated, List, Union
+from utils.metrics import histogram, counter
 
 
 PageBox = Annotated[List[tuple], "[(page_num, [(x, y, left, bottom)*])*]"]
 IMAGE_DPI = 72
+# format name -> (PIL format, mime type)
+IMAGE_FORMATS = {
+    'png': ('PNG', 'image/png'),
+    'webp': ('WEBP', 'image/webp'),
+    'jpeg': ('JPEG', 'image/jpeg'),
+}
+# pdfium isn't thread safe, not even with different documents, so every
+# pdfium call of a process is serialized. The documents are spread over
+# RENDER_WORKERS processes (0: render in this process) to use several cores.
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", min(4, os.cpu_count() or 1)))
+# approximate memory of the open documents, split between the workers
+PDF_POOL_BYTES = int(os.environ.get("PDF_POOL_BYTES", 512 * 1024 * 1024))
+# pdfium memory of a document besides its file size, per page
+PAGE_BYTES = 16 * 1024
+# memory of the rendered pages kept in the backend (3 bytes per RGB pixel)
+PAGE_CACHE_BYTES = int(os.environ.get("PAGE_CACHE_BYTES", 256 * 1024 * 1024))
+pdfium_lock = threading.Lock()
 
+RENDER_SECONDS = histogram('woodpecker_render_seconds', 'Time to render a highlighted pdf image.', ['format'])
+PAGE_CACHE = counter('woodpecker_page_cache_total', 'Rendered page cache lookups.', ['result'])
 
-pdf_cache = None
-def get_pdf_cache():
-    global pdf_cache
-    if pdf_cache is None:
-        pdf_cache = PdfCache()
-    return pdf_cache
-
-
-class PdfCache:
-    MAX_NUM = 8
-
-    def __init__(self):
-        self.cache = {}
-        self.keys = []
-
-    def get(self, fn):
-        doc = self.cache.get(fn, None)
-        if doc is not None:
-            self.update_cache(fn, hit=True)
-            return doc
-        self.update_cache(fn)
-        if not fn.startswith("/"):
-            abs_fn = os.path.join(os.getcwd(), fn)
-        else:
-            abs_fn = fn
-        ret = self.cache[fn] = pdfium.PdfDocument(abs_fn)
-        return ret
-
-    def update_cache(self, fn, hit=False):
-        if hit:
-            del self.keys[self.keys.index(fn)]
-            self.keys.append(fn)
-        else:
-            if len(self.keys) > PdfCache.MAX_NUM:
-                del self.cache[self.keys[0]]
-                self.keys.pop(0)
-            self.keys.append(fn)
-
-
-def render_image(filename: str, page_boxes: PageBox, offset: int = None) -> bytes:
-    def enlarge_bbox(bbox):
-        offset = 4
-        return bbox[0] - offset, bbox[1] - offset, bbox[2] + offset, bbox[3] + offset
 
+class PdfEntry:
+    def __init__(self, stamp, document, size):
+        self.stamp = stamp
+        self.document = document
+        self.size = size
+        # held while the document is used, a document is never closed under a user
+        self.lock = threading.Lock()
+        self.retired = False
+
+
+class DocumentPool:
+    """
+    The open pdfium documents by file, least recently used first.
+
+    A document is used by one thread at a time (see open), while threads using
+    other documents go on. Once the approximate size of the open documents
+    passes budget, the least recently used ones not in use are closed. A file
+    replaced on disk (other mtime or size) is opened again.
+    """
+
+    def __init__(self, budget=PDF_POOL_BYTES):
+        self.budget = budget
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def open(self, filename):
+        """The document of filename, locked for the caller until the with block ends."""
+        while True:
+            entry = self.entry(filename)
+            entry.lock.acquire()
+            if entry.document is not None:
+                break
+            # closed between the lookup and the lock
+            entry.lock.release()
+        try:
+            yield entry.document
+        finally:
+            if entry.retired:
+                self.close(entry)
+            entry.lock.release()
+
+    def entry(self, filename, evict=True):
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            entry = self.entries.get(path, None)
+            if entry is not None and entry.stamp == stamp:
+                self.entries.move_to_end(path)
+                return entry
+
+        with pdfium_lock:
+            document = pdfium.PdfDocument(path)
+            size = stat.st_size + len(document) * PAGE_BYTES
+        entry = PdfEntry(stamp, document, size)
+        with self.lock:
+            current = self.entries.get(path, None)
+            if current is not None and current.stamp == stamp:
+                # opened by another thread in the meantime
+                duplicate, entry = entry, current
+                self.entries.move_to_end(path)
+                duplicate.lock.acquire()
+                closing = [duplicate]
+            else:
+                closing = [] if current is None else self.retire(path)
+                self.entries[path] = entry
+                self.size += entry.size
+                if evict:
+                    closing += self.evict(keep=path)
+        for old in closing:
+            self.close(old)
+            old.lock.release()
+        return entry
+
+    def retire(self, path):
+        """Removes path from the pool, with the lock: returns the entries to close (locked)."""
+        entry = self.entries.pop(path)
+        self.size -= entry.size
+        entry.retired = True
+        # in use, closed by its user
+        if not entry.lock.acquire(blocking=False):
+            return []
+        return [entry]
+
+    def evict(self, keep=None):
+        """With the lock: retires unused documents until the pool fits its budget."""
+        closing = []
+        for path in list(self.entries):
+            if self.size <= self.budget:
+                break
+            entry = self.entries[path]
+            if path == keep or entry.lock.locked():
+                continue
+            closing += self.retire(path)
+        return closing
+
+    @staticmethod
+    def close(entry):
+        if entry.document is not None:
+            with pdfium_lock:
+                entry.document.close()
+            entry.document = None
+
+    def prewarm(self, filenames):
+        """Opens the files in order as long as they fit the budget, nothing is evicted for them."""
+        for filename in filenames:
+            try:
+                if self.size + os.path.getsize(filename) > self.budget:
+                    break
+                self.entry(filename, evict=False)
+            except (OSError, pdfium.PdfiumError):
+                continue
+
+    def clear(self):
+        with self.lock:
+            closing = []
+            for path in list(self.entries):
+                closing += self.retire(path)
+        for entry in closing:
+            self.close(entry)
+            entry.lock.release()
+
+
+document_pool = None
+document_pool_lock = threading.Lock()
+
+
+def get_document_pool():
+    """The documents of this process (a render worker, or the backend with RENDER_WORKERS = 0)."""
+    global document_pool
+    with document_pool_lock:
+        if document_pool is None:
+            document_pool = DocumentPool(PDF_POOL_BYTES // max(RENDER_WORKERS, 1))
+        return document_pool
+
+
+def _render_page(filename, page_index, scale):
+    with get_document_pool().open(filename) as document:
+        with pdfium_lock:
+            page = document[page_index]
+            image = page.render(scale=scale, draw_annots=False).to_pil().convert("RGB")
+            page.close()
+    return image.size, image.tobytes()
+
+
+def _page_count(filename):
+    with get_document_pool().open(filename) as document:
+        with pdfium_lock:
+            return len(document)
+
+
+def _prewarm(filenames):
+    get_document_pool().prewarm(filenames)
+
+
+render_executors = None
+render_executors_lock = threading.Lock()
+
+
+def get_render_executors():
+    global render_executors
+    with render_executors_lock:
+        if render_executors is None:
+            # one single threaded process per worker, each owns its documents
+            render_executors = [
+                ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) for _ in range(RENDER_WORKERS)
+            ]
+        return render_executors
+
+
+def owner_of(path):
+    executors = get_render_executors()
+    return executors[zlib.crc32(path.encode('utf-8', 'surrogatepass')) % len(executors)]
+
+
+def run_on_owner(func, filename, *args):
+    """Runs func(filename, *args) in the render worker owning the document of filename."""
+    path = os.path.abspath(filename)
+    if RENDER_WORKERS <= 0:
+        return func(path, *args)
+    return owner_of(path).submit(func, path, *args).result()
+
+
+def prewarm_documents(filenames):
+    """
+    Opens the documents of filenames (most important first) in the background,
+    in their render workers, as long as they fit the document budget.
+    """
+    paths = [os.path.abspath(filename) for filename in filenames if os.path.exists(filename)]
+    if RENDER_WORKERS <= 0:
+        threading.Thread(target=_prewarm, args=(paths,), daemon=True).start()
+        return
+    owned = {}
+    for path in paths:
+        owned.setdefault(owner_of(path), []).append(path)
+    for executor, owned_paths in owned.items():
+        executor.submit(_prewarm, owned_paths)
+
+
+def file_stamp(filename):
+    """(mtime, size) of a file, a replaced file gets another stamp."""
+    stat = os.stat(filename)
+    return stat.st_mtime_ns, stat.st_size
+
+
+class PageCache:
+    """
+    LRU cache of rendered pages (RGB PIL images) keyed by (file, page, scale)
+    and the stamp of the file, a replaced file is rendered again. Once the
+    pixels of the pages pass budget, the least recently used ones are dropped,
+    a page larger than budget isn't kept. The page counts of the files are
+    kept too, so a page found here never waits for its render worker.
+    """
+    MAX_COUNTS = 4096
+
+    def __init__(self, budget=PAGE_CACHE_BYTES):
+        self.budget = budget
+        self.cache = OrderedDict()
+        self.size = 0
+        self.page_counts = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, filename, page, scale, stamp=None):
+        key = (filename, page, scale, stamp or file_stamp(filename))
+        with self.lock:
+            image = self.cache.get(key, None)
+            if image is not None:
+                self.cache.move_to_end(key)
+                PAGE_CACHE.inc(result='hit')
+                return image
+        PAGE_CACHE.inc(result='miss')
+        size, pixels = run_on_owner(_render_page, filename, page, scale)
+        image = Image.frombytes("RGB", size, pixels)
+        image_size = image.width * image.height * 3
+        if image_size > self.budget:
+            return image
+        with self.lock:
+            old = self.cache.pop(key, None)
+            if old is not None:
+                # rendered by another thread in the meantime
+                self.size -= old.width * old.height * 3
+            self.cache[key] = image
+            self.size += image_size
+            while self.size > self.budget:
+                _, evicted = self.cache.popitem(last=False)
+                self.size -= evicted.width * evicted.height * 3
+        return image
+
+    def page_count(self, filename, stamp=None):
+        key = (filename, stamp or file_stamp(filename))
+        with self.lock:
+            count = self.page_counts.get(key, None)
+            if count is not None:
+                self.page_counts.move_to_end(key)
+                return count
+        count = run_on_owner(_page_count, filename)
+        with self.lock:
+            self.page_counts[key] = count
+            while len(self.page_counts) > PageCache.MAX_COUNTS:
+                self.page_counts.popitem(last=False)
+        return count
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            self.size = 0
+            self.page_counts.clear()
+
+
+page_cache = PageCache()
+
+
+def clear_render_cache():
+    """Drops the open documents and rendered pages, the files may be replaced."""
+    global render_executors
+    with render_executors_lock:
+        executors, render_executors = render_executors, None
+    for executor in executors or []:
+        executor.shutdown(wait=False, cancel_futures=True)
+    get_document_pool().clear()
+    page_cache.clear()
+
+
+def clamp_page(page, page_count):
+    return min(max(page, 0), page_count - 1)
+
+
+def stitch_images(images, gap=8):
+    """Stacks images vertically, separated by a gray gap."""
+    if len(images) == 1:
+        return images[0]
+    width = max(image.width for image in images)
+    height = sum(image.height for image in images) + gap * (len(images) - 1)
+    stitched = Image.new("RGB", (width, height), (200, 200, 200))
+    top = 0
+    for image in images:
+        stitched.paste(image, (0, top))
+        top += image.height + gap
+    return stitched
+
+
+def get_page_count(filename):
+    return page_cache.page_count(filename)
+
+
+def crop_image(image, bboxes, margin):
+    """Crops image to the union of bboxes (in pixels) plus margin pixels."""
+    left = max(min(bbox[0] for bbox in bboxes) - margin, 0)
+    top = max(min(bbox[1] for bbox in bboxes) - margin, 0)
+    right = min(max(bbox[2] for bbox in bboxes) + margin, image.width)
+    bottom = min(max(bbox[3] for bbox in bboxes) + margin, image.height)
+    if right <= left or bottom <= top:
+        return image
+    return image.crop((int(left), int(top), int(right), int(bottom)))
+
+
+def enlarge_bbox(bbox):
+    offset = 4
+    return bbox[0] - offset, bbox[1] - offset, bbox[2] + offset, bbox[3] + offset
+
+
+def render_image(filename: str, page_boxes: PageBox, offset: int = None, dpi: int = IMAGE_DPI,
+                 crop: float = None, image_format: str = 'png', quality: int = 85) -> bytes:
+    """
+    Renders the pages of page_boxes with their boxes highlighted, several
+    pages are stitched into one image from top to bottom.
+
+    Args:
+        dpi: The resolution of the image, bboxes are in points (1/72 inch).
+        crop: If given, every page is cut down to its boxes plus this margin
+            (in points). Pages without boxes are shown whole.
+        image_format: One of IMAGE_FORMATS.
+        quality: The quality of webp and jpeg images.
+    """
+    if image_format not in IMAGE_FORMATS:
+        raise ValueError(f"Unknown image format {image_format}")
+    with RENDER_SECONDS.time(format=image_format):
+        return _render_image(filename, page_boxes, offset, dpi, crop, image_format, quality)
+
+
+def _render_image(filename, page_boxes, offset, dpi, crop, image_format, quality):
     if offset is None:
         delta = 0
     else:
         delta = int(offset)
-    doc = get_pdf_cache().get(filename)
-    pages = [page for page, _ in page_boxes]
-    if len(pages) == 0:
-        image = doc[0].render(scale=IMAGE_DPI / 72, draw_annots=False).to_pil()
-        buf = io.BytesIO()
-        image.save(buf, format="PNG")
-        return buf.getvalue()
-    min_page, max_page = min(pages), max(pages)
-    page_dict = {p: [] for p in range(min_page, max_page + 1)}
+    scale = dpi / 72
+    # one stat for the whole image, the worker is only asked on a cache miss
+    stamp = file_stamp(filename)
+    page_count = page_cache.page_count(filename, stamp)
+    if len(page_boxes) == 0:
+        page_boxes = [(0, None)]
+    page_dict = {}
     for page, bbox in page_boxes:
-        if bbox is not None:
-            page_dict[page].append(bbox)
-    page = page_boxes[0][0] + delta
-
-    image = None
-    if 0 <= page < len(doc):
-        image = doc[page].render(scale=IMAGE_DPI / 72, draw_annots=False).to_pil()
-    elif page < 0:
-        image = doc[0].render(scale=IMAGE_DPI / 72, draw_annots=False).to_pil()
-    else: # page >= len(doc):
-        image = doc[len(doc) - 1].render(scale=IMAGE_DPI / 72, draw_annots=False).to_pil()
-
-    image = image.convert("RGB")
-    bboxes = page_dict.get(page, None)
-    if bboxes:
+        shown = clamp_page(page + delta, page_count)
+        page_dict.setdefault(shown, [])
+        # a page out of range shows the first or last page, without boxes
+        if bbox is not None and shown == page + delta:
+            page_dict[shown].append(bbox)
+
+    images = []
+    for page in sorted(page_dict):
+        # the cached page stays clean, boxes are drawn on a copy
+        image = page_cache.get(filename, page, scale, stamp).copy()
+        draw = ImageDraw.Draw(image)
+        bboxes = [[value * scale for value in enlarge_bbox(bbox)] for bbox in page_dict[page]]
         for bbox in bboxes:
-            draw = ImageDraw.Draw(image)
-            bbox = enlarge_bbox(bbox)
             draw.rectangle(bbox, outline=(255, 0, 0), width=3)
+        if crop is not None and bboxes:
+            image = crop_image(image, bboxes, crop * scale)
+        images.append(image)
     buf = io.BytesIO()
-    image.save(buf, format="PNG")
+    pil_format, _ = IMAGE_FORMATS[image_format]
+    if pil_format == 'PNG':
+        stitch_images(images).save(buf, format=pil_format)
+    else:
+        stitch_images(images).save(buf, format=pil_format, quality=quality)
     return buf.getvalue()
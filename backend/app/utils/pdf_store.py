@@ -0,0 +1,54 @@
+import os
+import shutil
+import hashlib
+
+# scan results by pdf content, kept outside of the upload folder so that they
+# survive a cleanup
+STORE_DIR = os.environ.get("PDF_STORE_DIR", "store")
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def store_path(digest):
+    return os.path.join(STORE_DIR, digest[:2], digest + ".pdf.json")
+
+
+def link_or_copy(source, target):
+    """Places a hard link (or a copy, across devices) of source at target atomically."""
+    os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+    tmp_path = f"{target}.{os.getpid()}.tmp"
+    try:
+        os.link(source, tmp_path)
+    except OSError:
+        shutil.copyfile(source, tmp_path)
+    os.replace(tmp_path, target)
+
+
+def restore_scan(digest, scaned_file):
+    """
+    Puts the stored scan result of a pdf with this digest at scaned_file.
+
+    Returns:
+        True if the store had a result.
+    """
+    stored = store_path(digest)
+    if not os.path.exists(stored):
+        return False
+    link_or_copy(stored, scaned_file)
+    return True
+
+
+def save_scan(digest, scaned_file):
+    stored = store_path(digest)
+    if not os.path.exists(stored):
+        link_or_copy(scaned_file, stored)
@@ -0,0 +1,82 @@
+SORT_KEYS = {
+    'ratio': (lambda relation: relation[3], True),
+    'length': (lambda relation: len(relation[0]), True),
+    'position': (lambda relation: (relation[1].get('page', 0), relation[2].get('page', 0)), False),
+}
+
+
+def filter_relations(relations, min_length=0, min_ratio=0.0):
+    return [
+        relation for relation in relations
+        if len(relation[0]) >= min_length and relation[3] >= min_ratio
+    ]
+
+
+def page_relations(result, source, target, offset=0, limit=50, min_length=0, min_ratio=0.0, sort='ratio'):
+    """
+    One page of the relations between two documents of a comparison result.
+
+    Args:
+        result: A result of find_exact_same_substrings.
+        source, target: The pdf files of the pair, the relations are given as
+            (segment, source block, target block, ratio of source, source
+            spans, target spans). The spans are all blocks the segment covers,
+            with their page, bbox and the character range inside the block.
+        offset, limit: The page window.
+        min_length: Skip segments shorter than this.
+        min_ratio: Skip relations with a smaller ratio.
+        sort: 'ratio' or 'length' (descending) or 'position' (ascending page).
+
+    Returns:
+        A dictionary with the total number of matching relations and the page.
+    """
+    if sort not in SORT_KEYS:
+        raise ValueError(f"Unknown sort key {sort}")
+    relations = result['relation_matrix'].get(source, {}).get(target, None)
+    if relations is None:
+        raise KeyError(f"No relations between {source} and {target}")
+    relations = filter_relations(relations, min_length, min_ratio)
+    key, reverse = SORT_KEYS[sort]
+    relations = sorted(relations, key=key, reverse=reverse)
+    return {
+        "source": source,
+        "target": target,
+        "total": len(relations),
+        "offset": offset,
+        "limit": limit,
+        "relations": relations[offset:offset + limit]
+    }
+
+
+def summarize_relations(result, source, min_length=0, min_ratio=0.0):
+    """
+    Per target document: the number of relations of `source` with it, its
+    ratio and the relation with the highest ratio.
+    """
+    targets = result['relation_matrix'].get(source, None)
+    if targets is None:
+        raise KeyError(f"Unknown file {source}")
+    summary = {}
+    for target, relations in targets.items():
+        relations = filter_relations(relations, min_length, min_ratio)
+        summary[target] = {
+            "count": len(relations),
+            "ratio": result['ratio_matrix'][source][target],
+            "top": max(relations, key=lambda relation: relation[3]) if relations else None
+        }
+    return {
+        "source": source,
+        "relations": summary
+    }
+
+
+def rank_documents(result):
+    """
+    The documents with at least one relation, the most similar to another
+    document first: the ones a reviewer is going to open.
+    """
+    scores = {
+        source: max(row.values(), default=0.0)
+        for source, row in result['ratio_matrix'].items()
+    }
+    return [source for source, score in sorted(scores.items(), key=lambda item: -item[1]) if score > 0]
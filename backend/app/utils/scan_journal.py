@@ -0,0 +1,66 @@
+import os
+import sqlite3
+import threading
+
+# kept outside of the upload folder, a cleanup clears it through FileStatus
+SCAN_JOURNAL = os.environ.get("SCAN_JOURNAL", "scan_journal.db")
+
+
+class ScanJournal:
+    """
+    The scan queue on disk: one row per known pdf file with its KBPort job key,
+    so that a restarted backend can pick up the jobs that are still running.
+    """
+    def __init__(self, path=SCAN_JOURNAL):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS scans ("
+            " pdf_file TEXT PRIMARY KEY,"
+            " scaned_file TEXT NOT NULL,"
+            " digest TEXT,"
+            " scan_key TEXT,"
+            " state TEXT NOT NULL)"
+        )
+
+    @staticmethod
+    def row(scan_obj):
+        return (scan_obj['fullname'], scan_obj['scaned_file'], scan_obj['digest'],
+                scan_obj['scan_key'], scan_obj['status']['state'])
+
+    def save(self, scan_objs):
+        rows = [self.row(scan_obj) for scan_obj in scan_objs]
+        if not rows:
+            return
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT INTO scans (pdf_file, scaned_file, digest, scan_key, state) VALUES (?, ?, ?, ?, ?)"
+                " ON CONFLICT(pdf_file) DO UPDATE SET scaned_file=excluded.scaned_file,"
+                " digest=excluded.digest, scan_key=excluded.scan_key, state=excluded.state",
+                rows)
+
+    def replace(self, scan_objs):
+        """Replaces the whole journal with scan_objs."""
+        rows = [self.row(scan_obj) for scan_obj in scan_objs]
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM scans")
+            self.db.executemany(
+                "INSERT INTO scans (pdf_file, scaned_file, digest, scan_key, state) VALUES (?, ?, ?, ?, ?)",
+                rows)
+
+    def load(self):
+        """
+        Returns:
+            A list of (pdf file, scanned file, digest, scan key, state) in the
+            order the files were added.
+        """
+        with self.lock:
+            return self.db.execute(
+                "SELECT pdf_file, scaned_file, digest, scan_key, state FROM scans ORDER BY rowid").fetchall()
+
+    def clear(self):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM scans")
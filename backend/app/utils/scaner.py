@@ -1,44 +1,219 @@
 import os
 from utils.kbport import KBPort
 from utils.file_man import UPLOAD_DIR, collect_pdf_files
+from utils.pdf_store import hash_file, restore_scan, save_scan
+from utils.scan_journal import ScanJournal
+from utils.doc_cache import prepare_text_document
+from utils.metrics import histogram, counter, gauge
 import threading
+import asyncio
 import json
 import time
+from concurrent.futures import ThreadPoolExecutor, Future
 
 KBPORT_URL = os.environ.get("KBPORT_URL")
-scan_api = KBPort("woodpecker", "111", KBPORT_URL)
+SCAN_CONCURRENCY = int(os.environ.get("SCAN_CONCURRENCY", 8))
+scan_api = KBPort("woodpecker", "111", KBPORT_URL, max_concurrency=SCAN_CONCURRENCY)
+SCAN_POLL_INTERVAL = 0.5
+# while no job makes progress, the poll interval doubles up to this
+SCAN_MAX_POLL_INTERVAL = 8.0
+scan_executor = ThreadPoolExecutor(max_workers=SCAN_CONCURRENCY)
+
+
+def new_scan_obj(pdf_file, scaned_pdf_file, digest=None):
+    scan_obj = {
+        'name': os.path.basename(pdf_file),
+        'fullname': pdf_file,
+        'scaned_file': scaned_pdf_file,
+        'digest': digest,
+        'scan_key': None,
+        'status': {
+            'state': 'pending',
+            'message': '发现待扫描的文件!'
+        },
+        'progress': 0,
+        'version': 0
+    }
+    if os.path.exists(scaned_pdf_file):
+        scan_obj['status'] = {
+            'state': 'completed',
+            'message': '发现已扫描的文件!'
+        }
+        scan_obj['progress'] = 100
+    return scan_obj
+
+
+def in_flight(scan_obj):
+    return scan_obj['scan_key'] is not None and scan_obj['status']['state'] not in ('completed', 'error')
 
 
 class FileStatus:
-    def __init__(self):
+    def __init__(self, journal):
         self.file_status = {}
+        # the persisted copy of the file list and the KBPort job keys
+        self.journal = journal
         self.work_lock = threading.Lock()
+        # every change bumps version and stamps the changed entry with it,
+        # collect() starts a new generation (the whole list is replaced)
+        self.version = 0
+        self.generation = 0
+        self.listeners = set()
+        # set whenever the scan worker has something new to do
+        self.wakeup = threading.Event()
+        # pdf digest -> the file whose KBPort job will produce its result
+        self.claims = {}
 
     def collect(self):
         with self.work_lock:
+            previous = self.file_status
             self.file_status = {}
             pdf_files = collect_pdf_files()
             for pdf_file, scaned_pdf_file in pdf_files:
-                self.file_status[pdf_file] = {
-                    'name': os.path.basename(pdf_file),
-                    'fullname': pdf_file,
-                    'scaned_file': scaned_pdf_file,
-                    'scan_key': None,
-                    'status': {
+                scan_obj = previous.get(pdf_file, None)
+                # files with a running KBPort job keep it
+                if scan_obj is None or not in_flight(scan_obj) or os.path.exists(scaned_pdf_file):
+                    scan_obj = new_scan_obj(pdf_file, scaned_pdf_file)
+                self.file_status[pdf_file] = scan_obj
+            self.journal.replace(self.file_status.values())
+            self.generation += 1
+            self.notify()
+        self.wakeup.set()
+
+    def register(self, pdf_files):
+        """
+        Adds (or resets) the given (pdf file, scanned file, sha256) tuples.
+        Files whose content was scanned before are completed right away.
+        """
+        for pdf_file, scaned_pdf_file, digest in pdf_files:
+            if not os.path.exists(scaned_pdf_file):
+                restore_scan(digest, scaned_pdf_file)
+        with self.work_lock:
+            for pdf_file, scaned_pdf_file, digest in pdf_files:
+                scan_obj = self.file_status[pdf_file] = new_scan_obj(pdf_file, scaned_pdf_file, digest)
+                self.touch(scan_obj)
+            self.journal.save(self.file_status[pdf_file] for pdf_file, _, _ in pdf_files)
+        self.wakeup.set()
+
+    def resume(self):
+        """
+        Loads the file list of a previous run from the journal, files whose
+        KBPort job was still running are polled again instead of resubmitted.
+
+        Returns:
+            The number of reattached jobs.
+        """
+        reattached = 0
+        with self.work_lock:
+            for pdf_file, scaned_pdf_file, digest, scan_key, state in self.journal.load():
+                if not os.path.exists(pdf_file):
+                    continue
+                scan_obj = new_scan_obj(pdf_file, scaned_pdf_file, digest)
+                if scan_obj['status']['state'] != 'completed' and scan_key is not None and state != 'error':
+                    scan_obj['scan_key'] = scan_key
+                    scan_obj['status'] = {
                         'state': 'pending',
-                        'message': '发现待扫描的文件!'
-                    },
-                    'progress': 0
-                }
-                if os.path.exists(scaned_pdf_file):
-                    self.file_status[pdf_file]['status'] = {
-                        'state': 'completed',
-                        'message': '发现已扫描的文件!'
+                        'message': '重新连接扫描任务...'
                     }
-                    g_file_status.file_status[pdf_file]['progress'] = 100
+                    if digest is not None:
+                        self.claims[digest] = pdf_file
+                    reattached += 1
+                self.file_status[pdf_file] = scan_obj
+            self.journal.replace(self.file_status.values())
+            self.generation += 1
+            self.notify()
+        return reattached
+
+    def claim(self, digest, pdf_file):
+        """
+        Makes pdf_file responsible for scanning the content `digest`.
+
+        Returns:
+            False if another file with the same content is already being scanned.
+        """
+        with self.work_lock:
+            owner = self.claims.setdefault(digest, pdf_file)
+            return owner == pdf_file
+
+    def release(self, digest, pdf_file):
+        """Must be called with work_lock held."""
+        if self.claims.get(digest, None) == pdf_file:
+            del self.claims[digest]
+
+    def clear(self):
+        with self.work_lock:
+            self.file_status = {}
+            self.claims = {}
+            self.journal.clear()
+            self.generation += 1
+            self.notify()
 
+    def touch(self, scan_obj):
+        """Marks scan_obj as changed, must be called with work_lock held."""
+        self.version += 1
+        scan_obj['version'] = self.version
+        self.notify()
 
-g_file_status = FileStatus()
+    def notify(self):
+        for loop, event in list(self.listeners):
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # the listener's event loop is closed
+                self.listeners.discard((loop, event))
+
+    def subscribe(self, loop, event):
+        with self.work_lock:
+            self.listeners.add((loop, event))
+
+    def unsubscribe(self, loop, event):
+        with self.work_lock:
+            self.listeners.discard((loop, event))
+
+    def changes_since(self, generation, version):
+        """
+        The files changed after (generation, version), or all files if the
+        list was re-collected since.
+        """
+        with self.work_lock:
+            reset = generation != self.generation
+            files = []
+            completed = 0
+            for scan_obj in self.file_status.values():
+                if scan_obj['status']['state'] == 'completed':
+                    completed += 1
+                if reset or scan_obj['version'] > version:
+                    files.append({
+                        'name': scan_obj['name'],
+                        'fullname': scan_obj['fullname'],
+                        'status': scan_obj['status'],
+                        'progress': scan_obj['progress']
+                    })
+            return {
+                'generation': self.generation,
+                'version': self.version,
+                'reset': reset,
+                'files': files,
+                'partial_done': completed > 1,
+                'all_done': completed == len(self.file_status)
+            }
+
+
+g_file_status = FileStatus(ScanJournal())
+
+
+def count_scan_states():
+    counts = {}
+    with g_file_status.work_lock:
+        for scan_obj in g_file_status.file_status.values():
+            key = (scan_obj['status']['state'],)
+            counts[key] = counts.get(key, 0) + 1
+    return counts
+
+
+SCAN_FILES = gauge('woodpecker_scan_files', 'Files known to the scanner by state (the scan queue).',
+                   ['state'], callback=count_scan_states)
+SCAN_STEP_SECONDS = histogram('woodpecker_scan_step_seconds', 'Duration of a pass of the scan worker.')
+SCAN_JOBS = counter('woodpecker_scan_jobs_total', 'Scans by how they ended.', ['result'])
 work_thread = None
 
 
@@ -46,10 +221,30 @@ def collect_files():
     g_file_status.collect()
 
 
+def register_files(pdf_files):
+    g_file_status.register(pdf_files)
+
+
+def clear_files():
+    g_file_status.clear()
+
+
+def has_files():
+    with g_file_status.work_lock:
+        return len(g_file_status.file_status) > 0
+
+
 def start_scan():
     global work_thread
     if work_thread is None:
         start_scan_loop()
+    g_file_status.wakeup.set()
+
+
+def resume_scan():
+    """Restores the scan state of the previous run, polling its running jobs."""
+    if g_file_status.resume():
+        start_scan()
 
 
 def get_scan_status():
@@ -77,82 +272,275 @@ def get_scan_status():
     }
 
 
+def submit_file(pdf_file, scaned_file, digest):
+    if digest is None:
+        digest = hash_file(pdf_file)
+    if restore_scan(digest, scaned_file):
+        return {
+            'digest': digest,
+            'status': {
+                'state': 'completed',
+                'message': '发现相同内容的已扫描文件!'
+            },
+            'progress': 100
+        }
+    if not g_file_status.claim(digest, pdf_file):
+        return {
+            'digest': digest,
+            'status': {
+                'state': 'pending',
+                'message': '等待相同内容的文件扫描完成...'
+            }
+        }
+    job = scan_api.single_parse_job(pdf_file, "result")
+    if job is None or not job.status:
+        return {'digest': digest}
+    SCAN_JOBS.inc(result='submitted')
+    return {
+        'digest': digest,
+        'scan_key': job.result_path,
+        'status': {
+            'state': 'pending',
+            'message': '已将待扫描文件入队...'
+        },
+        'progress': 0
+    }
+
+
+def poll_file(scan_key, scaned_file, digest, status=None):
+    """
+    The update of a submitted file from its KBPort job status, fetched if not
+    given. Only a finished job costs a request (for its result).
+    """
+    if status is None:
+        status = scan_api.get_job_status(scan_key)
+    if status['status'] == "started":
+        progress = json.loads(status['message'])
+        stage = progress.get("stage", None)
+        page = progress.get("page_id", 0)
+        total = progress.get("total_page", 1)
+        if page < 0:
+            page = 0
+        if stage is None:
+            desc = "扫描状态未知"
+        else:
+            desc = f"扫描阶段: {stage} [{page} / {total}]"
+        if total > 0:
+            progress = int(page / total * 100)
+        else:
+            progress = 0
+        return {
+            'status': {
+                'state': 'progressing',
+                'message': desc
+            },
+            'progress': progress
+        }
+    elif status['status'] == 'finished':
+        scan_api.download_job_result(scan_key, scaned_file)
+        # the compact text for the comparisons, parsed once while scanning
+        prepare_text_document(scaned_file)
+        if digest is not None:
+            save_scan(digest, scaned_file)
+        SCAN_JOBS.inc(result='completed')
+        return {
+            'status': {
+                'state': 'completed',
+                'message': "扫描完成！"
+            },
+            'progress': 100
+        }
+    elif status['status'] == 'failed':
+        SCAN_JOBS.inc(result='failed')
+        return {
+            'status': {
+                'state': 'error',
+                'message': status['message']
+            }
+        }
+    return None
+
+
+def scan_single_file(pdf_file, scaned_file, result_dir="templates", time_out=7200):
+    """
+    Scans one pdf outside of the file list (a template), blocking until the
+    scanned json is at scaned_file. Raises if the scan fails.
+    """
+    digest = hash_file(pdf_file)
+    if restore_scan(digest, scaned_file):
+        prepare_text_document(scaned_file)
+        return
+    job = scan_api.single_parse_job(pdf_file, result_dir)
+    if not job.status:
+        raise Exception(f"Scanning {pdf_file} failed: {job.message}")
+    start_time = time.time()
+    interval = SCAN_POLL_INTERVAL
+    while time.time() - start_time < time_out:
+        update = poll_file(job.result_path, scaned_file, digest)
+        if update is not None and update['status']['state'] == 'completed':
+            return
+        if update is not None and update['status']['state'] == 'error':
+            raise Exception(update['status']['message'])
+        time.sleep(interval)
+        interval = min(interval * 2, SCAN_MAX_POLL_INTERVAL)
+    raise Exception(f"Scanning {pdf_file} timed out")
+
+
+def fetch_all_status():
+    """The status of all KBPort jobs by scan key, empty if KBPort can't tell."""
+    try:
+        return {job['result_path']: job for job in scan_api.get_all_status()}
+    except Exception as e:
+        print(f"fetching the scan status failed: {e}")
+        return {}
+
+
+def scan_step():
+    """
+    One pass over all files: submits the pending ones concurrently and
+    refreshes the submitted ones with a single get_all_status call, only the
+    results of newly finished jobs are fetched. work_lock is only held to read
+    the state and to apply the updates, never during network I/O.
+
+    Returns:
+        (The number of files that still need work, whether any file changed).
+    """
+    tasks = []
+    polled = []
+    with g_file_status.work_lock:
+        for pdf_file, scan_obj in g_file_status.file_status.items():
+            if scan_obj['status']['state'] in ('completed', 'error'):
+                continue
+            if os.path.exists(scan_obj['scaned_file']):
+                scan_obj['status'] = {
+                    'state': 'completed',
+                    'message': '发现已扫描的文件!'
+                }
+                scan_obj['progress'] = 100
+                g_file_status.touch(scan_obj)
+                g_file_status.journal.save([scan_obj])
+            elif scan_obj['scan_key'] is None:
+                tasks.append((pdf_file, None, scan_executor.submit(
+                    submit_file, pdf_file, scan_obj['scaned_file'], scan_obj['digest'])))
+            else:
+                polled.append((pdf_file, scan_obj['scan_key'], scan_obj['scaned_file'], scan_obj['digest']))
+
+    statuses = fetch_all_status() if polled else {}
+    for pdf_file, scan_key, scaned_file, digest in polled:
+        status = statuses.get(scan_key, None)
+        if status is None or status['status'] == 'finished':
+            # a result to download, or a job missing from the listing
+            tasks.append((pdf_file, scan_key, scan_executor.submit(
+                poll_file, scan_key, scaned_file, digest, status)))
+        else:
+            try:
+                tasks.append((pdf_file, scan_key, poll_file(scan_key, scaned_file, digest, status)))
+            except Exception as e:
+                # a malformed status, the next pass polls it again
+                print(f"polling the scan of {pdf_file} failed: {e}")
+                tasks.append((pdf_file, scan_key, None))
+
+    changed = False
+    for pdf_file, scan_key, update in tasks:
+        if isinstance(update, Future):
+            try:
+                update = update.result()
+            except Exception as e:
+                print(f"scan of {pdf_file} failed: {e}")
+                continue
+        if update is None:
+            continue
+        with g_file_status.work_lock:
+            scan_obj = g_file_status.file_status.get(pdf_file, None)
+            # the file list may have been re-collected in the meantime
+            if scan_obj is None or scan_obj['scan_key'] != scan_key:
+                continue
+            if all(scan_obj.get(key, None) == value for key, value in update.items()):
+                continue
+            changed = True
+            state = scan_obj['status']['state']
+            scan_obj.update(update)
+            if scan_obj['status']['state'] in ('completed', 'error') and scan_obj['digest'] is not None:
+                g_file_status.release(scan_obj['digest'], pdf_file)
+            g_file_status.touch(scan_obj)
+            # progress isn't worth a write, job keys and final states are
+            if scan_obj['scan_key'] != scan_key or scan_obj['status']['state'] != state:
+                g_file_status.journal.save([scan_obj])
+    return len(tasks), changed
+
+
+def reattach_jobs():
+    """
+    Checks the jobs resumed from the journal against KBPort with a single
+    get_all_status call, jobs KBPort doesn't know anymore are submitted again.
+    """
+    with g_file_status.work_lock:
+        if not any(in_flight(scan_obj) for scan_obj in g_file_status.file_status.values()):
+            return
+    try:
+        known = {job['result_path'] for job in scan_api.get_all_status()}
+    except Exception as e:
+        # keep the job keys, polling them tells what happened
+        print(f"reattaching scan jobs failed: {e}")
+        return
+    with g_file_status.work_lock:
+        for pdf_file, scan_obj in g_file_status.file_status.items():
+            if in_flight(scan_obj) and scan_obj['scan_key'] not in known:
+                if scan_obj['digest'] is not None:
+                    g_file_status.release(scan_obj['digest'], pdf_file)
+                scan_obj['scan_key'] = None
+                g_file_status.touch(scan_obj)
+                g_file_status.journal.save([scan_obj])
+
+
 def scan_loop():
+    try:
+        reattach_jobs()
+    except Exception as e:
+        print(f"reattaching scan jobs failed: {e}")
+    interval = SCAN_POLL_INTERVAL
     while True:
-        with g_file_status.work_lock:
-            pdf_files = list(g_file_status.file_status.keys())
-
-        if pdf_files:
-            for pdf_file in pdf_files:
-                with g_file_status.work_lock:
-                    if pdf_file not in g_file_status.file_status:
-                        break
-                    scan_obj = g_file_status.file_status[pdf_file]
-                    if scan_obj['status']['state'] == 'completed':
-                        continue
-                    if os.path.exists(scan_obj['scaned_file']):
-                        g_file_status.file_status[pdf_file]['status'] = {
-                            'state': 'completed',
-                            'message': '发现已扫描的文件!'
-                        }
-                        g_file_status.file_status[pdf_file]['progress'] = 100
-                    elif g_file_status.file_status[pdf_file]['scan_key'] is None:
-                        job = scan_api.single_parse_job(pdf_file, "result")
-                        if job is not None:
-                            if job.status:
-                                g_file_status.file_status[pdf_file]['scan_key'] = job.result_path
-                                print(f"commit job: {job.result_path}")
-                                g_file_status.file_status[pdf_file]['status'] = {
-                                    'state': 'pending',
-                                    'message': '已将待扫描文件入队...'
-                                }
-                                g_file_status.file_status[pdf_file]['progress'] = 0
-                    else:
-                        print(f"1:scanobj_scan_key={scan_obj['scan_key']}")
-                        status = scan_api.get_job_status(scan_obj['scan_key'])
-                        print(f"2:scanobj_scan_key={scan_obj['scan_key']}, status={status['status']}")
-                        if status['status'] == "started":
-                            progress = json.loads(status['message'])
-                            stage = progress.get("stage", None)
-                            page = progress.get("page_id", 0)
-                            total = progress.get("total_page", 1)
-                            if page < 0:
-                                page = 0
-                            if stage is None:
-                                desc = "扫描状态未知"
-                            else:
-                                desc = f"扫描阶段: {stage} [{page} / {total}]"
-                            if total > 0:
-                                progress = int(page / total * 100)
-                            else:
-                                progress = 0
-                            g_file_status.file_status[pdf_file]['status'] = {
-                                'state': 'progressing',
-                                'message': desc
-                            }
-                            g_file_status.file_status[pdf_file]['progress'] = progress
-                        elif status['status'] == 'finished':
-                            print(f"3:scanobj_scan_key={scan_obj['scan_key']}")
-                            json_data = scan_api.get_job_result(scan_obj['scan_key'])
-                            print(f"4:scanobj_scan_key={scan_obj['scan_key']}")
-                            with open(scan_obj['scaned_file'], "w") as f:
-                                json.dump(json_data, f)
-                                print(f"5:scanobj_scan_key={scan_obj['scan_key']}")
-                            g_file_status.file_status[pdf_file]['status'] = {
-                                'state': 'completed',
-                                'message': "扫描完成！"
-                            }
-                            g_file_status.file_status[pdf_file]['progress'] = 100
-
-                        elif status['status'] == 'failed':
-                            g_file_status.file_status[pdf_file]['status'] = {
-                                'state': 'error',
-                                'message': status['message']
-                            }
-                time.sleep(0.5)
-                print("tick")
-        else:
-            time.sleep(1)
+        g_file_status.wakeup.clear()
+        try:
+            with SCAN_STEP_SECONDS.time():
+                pending, changed = scan_step()
+        except Exception as e:
+            # the thread must outlive a bad pass, start_scan never restarts it
+            print(f"scan pass failed: {e}")
+            pending, changed = True, False
+        if not pending:
+            g_file_status.wakeup.wait()
+            interval = SCAN_POLL_INTERVAL
+            continue
+        # KBPort has no push channel, in-flight jobs have to be polled, less
+        # often while all of them are just waiting in the queue
+        interval = SCAN_POLL_INTERVAL if changed else min(interval * 2, SCAN_MAX_POLL_INTERVAL)
+        if g_file_status.wakeup.wait(interval):
+            interval = SCAN_POLL_INTERVAL
+
+
+async def file_status_events(keepalive=15):
+    """
+    Server-sent events with the file status: the first event carries all
+    files (reset=True), the following ones only the files that changed.
+    """
+    loop = asyncio.get_running_loop()
+    changed = asyncio.Event()
+    g_file_status.subscribe(loop, changed)
+    try:
+        generation, version = None, 0
+        while True:
+            delta = g_file_status.changes_since(generation, version)
+            generation, version = delta['generation'], delta['version']
+            if delta['reset'] or delta['files']:
+                yield f"data: {json.dumps(delta, ensure_ascii=False)}\n\n"
+            try:
+                await asyncio.wait_for(changed.wait(), keepalive)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+            changed.clear()
+    finally:
+        g_file_status.unsubscribe(loop, changed)
 
 
 def start_scan_loop():
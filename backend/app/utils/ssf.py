@@ -1,20 +1,46 @@
 import os.path
-import json
+import threading
 from collections import defaultdict
 from itertools import combinations
+import numpy as np
 from utils.file_man import collect_pdf_files
-from utils.find_position import find_index_by_value
+from utils.doc_cache import load_text_document
+from utils.corpus import Corpus
+from utils.suffix_array import build_suffix_array, build_lcp_array, find_maximal_repeats
+from utils.fuzzy import find_similar_segments
+from utils.boilerplate import suppress_boilerplate, template_shingles
+from utils.winnowing import kgram_hashes, find_candidate_pairs, group_pairs
+from utils.parallel import run_sharded, COMPARE_WORKERS
+from utils.metrics import histogram, counter
 
+COMPARE_STAGE_SECONDS = histogram('woodpecker_compare_stage_seconds',
+                                  'Time spent in every stage of a comparison.', ['stage'])
+COMPARES = counter('woodpecker_compares_total', 'Comparisons by how they were computed.', ['mode'])
 
-def find_exact_same_segments(paragraphs, min_len=4):
+# parts of the paragraphs outside focus closer than this are matched as one,
+# see focus_fragments
+FOCUS_GAP = 64
+
+
+def find_exact_same_segments(paragraphs, min_len=4, max_occurrences=1000, focus=None):
     """
     Finds all maximal exact-same segments (at least min_len Chinese characters)
-    across multiple Chinese paragraphs. A segment is maximal if it's not a
-    substring of another identified exact-same segment.
+    across multiple Chinese paragraphs. A segment is maximal if it can't be
+    extended to the left or to the right without losing one of its occurrences,
+    and it is reported only if it occurs in at least two paragraphs.
 
     Args:
-        paragraphs: A list of strings, where each string is a Chinese paragraph.
+        paragraphs: A list of Chinese paragraphs, as strings or as arrays of
+            utf-32 codes.
         min_len: The minimum length of the exact-same segment to consider.
+        max_occurrences: Segments occurring more often than this (separator
+            lines, page headers, ...) are skipped.
+        focus: Optional collection of paragraph indices. If given, only segments
+            with at least one occurrence in these paragraphs are returned, and
+            the other paragraphs are only matched where they share text with
+            them (see focus_fragments). The segments are maximal in that
+            reduced text, the pair matches of the focus paragraphs (see
+            find_pair_matches) are the ones of the whole paragraphs.
 
     Returns:
         A dictionary where keys are the maximal exact-same segments (strings) and
@@ -28,140 +54,575 @@ def find_exact_same_segments(paragraphs, min_len=4):
     if n < 2:
         return {}
 
-    combined_text = ""
-    paragraph_indices = []
-    paragraph_lengths = [len(p) for p in paragraphs]
-    for i, para in enumerate(paragraphs):
-        combined_text += para + chr(1)  # Use a unique separator not in Chinese
-        paragraph_indices.extend([i] * (len(para) + 1))
-
-    suffix_array = sorted(range(len(combined_text)), key=combined_text.__getitem__)
-
-    lcp_array = [0] * len(combined_text)
-    for i in range(1, len(combined_text)):
-        lcp_array[i] = longest_common_prefix_length(
-            combined_text, suffix_array[i - 1], suffix_array[i]
-        )
-
-    potential_segments = []
-    for i in range(1, len(lcp_array)):
-        if lcp_array[i] >= min_len:
-            print(lcp_array[i])
-            segment = combined_text[
-                suffix_array[i] : suffix_array[i] + lcp_array[i]
-            ]
-            para_index1 = paragraph_indices[suffix_array[i - 1]]
-            start_index1 = suffix_array[i - 1] - sum(paragraph_lengths[k] + 1 for k in range(para_index1))
-            ratio1 = len(segment) / paragraph_lengths[para_index1]
-
-            para_index2 = paragraph_indices[suffix_array[i]]
-            start_index2 = suffix_array[i] - sum(paragraph_lengths[k] + 1 for k in range(para_index2))
-            ratio2 = len(segment) / paragraph_lengths[para_index2]
-
-            if para_index1 != para_index2:
-                potential_segments.append(
-                    (segment, (para_index1, start_index1, ratio1), (para_index2, start_index2, ratio2))
-                )
+    origins = None
+    if focus is not None and len(set(focus)) < n:
+        with COMPARE_STAGE_SECONDS.time(stage='focus_fragments'):
+            fragments, owners, shifts = focus_fragments(paragraphs, set(focus), min_len)
+        origins = (owners, shifts, np.fromiter((len(p) for p in paragraphs), dtype=np.int64, count=n))
+        paragraphs = fragments
+        if len(paragraphs) < 2:
+            return {}
+
+    with COMPARE_STAGE_SECONDS.time(stage='corpus_build'):
+        corpus = Corpus(paragraphs)
+    groups = corpus.doc_ids if origins is None else origins[0][corpus.doc_ids]
+    with COMPARE_STAGE_SECONDS.time(stage='suffix_sort'):
+        suffix_array = build_suffix_array(corpus.codes)
+    with COMPARE_STAGE_SECONDS.time(stage='lcp'):
+        lcp_array = build_lcp_array(corpus.codes, suffix_array)
+    with COMPARE_STAGE_SECONDS.time(stage='maximal_repeats'):
+        repeats = find_maximal_repeats(corpus.codes, suffix_array, lcp_array, min_len,
+                                       groups, max_occurrences)
+    if not repeats:
+        return {}
 
-    maximal_segments = {}
-    processed_segments = set()
+    with COMPARE_STAGE_SECONDS.time(stage='occurrence_mapping'):
+        return map_occurrences(corpus, suffix_array, repeats, focus, origins)
+
+
+def focus_fragments(paragraphs, focus, min_len):
+    """
+    Cuts the paragraphs outside focus down to the parts sharing a min_len-gram
+    with a focus paragraph, the focus paragraphs are kept whole.
 
-    # Sort potential segments by length in descending order
-    potential_segments.sort(key=lambda x: len(x[0]), reverse=True)
+    Every common substring of a paragraph and a focus paragraph of at least
+    min_len characters lies inside one part, and so does the character next
+    to it if it still matches, so the matches with the focus paragraphs can
+    be found in the parts alone. Parts closer than FOCUS_GAP are joined.
 
-    for segment, occurrence1, occurrence2 in potential_segments:
-        if segment in processed_segments:
+    Returns:
+        (the parts, as arrays of codes or strings, the paragraph of every part
+        as an array, the start of every part in its paragraph as an array)
+    """
+    codes = [np.frombuffer(p.encode('utf-32-le', 'surrogatepass'), dtype=np.uint32) if isinstance(p, str) else p
+             for p in paragraphs]
+    grams = [kgram_hashes(codes[i], min_len) for i in sorted(focus)]
+    grams = np.unique(np.concatenate(grams)) if grams else np.zeros(0, dtype=np.uint64)
+    # a bitmap of the low hash bits rules out most k-grams before the search
+    low_bits = np.uint64((1 << 22) - 1)
+    bitmap = np.zeros(1 << 22, dtype=bool)
+    bitmap[grams & low_bits] = True
+    fragments, owners, shifts = [], [], []
+    for i, paragraph in enumerate(paragraphs):
+        if i in focus:
+            fragments.append(paragraph)
+            owners.append(i)
+            shifts.append(0)
+            continue
+        hashes = kgram_hashes(codes[i], min_len)
+        if len(hashes) == 0 or len(grams) == 0:
+            continue
+        starts = np.nonzero(bitmap[hashes & low_bits])[0]
+        places = np.minimum(np.searchsorted(grams, hashes[starts]), len(grams) - 1)
+        starts = starts[grams[places] == hashes[starts]]
+        if len(starts) == 0:
             continue
+        breaks = np.nonzero(starts[1:] - starts[:-1] > min_len + FOCUS_GAP)[0]
+        for begin, end in zip(starts[np.r_[0, breaks + 1]].tolist(), (starts[np.r_[breaks, -1]] + min_len).tolist()):
+            fragments.append(paragraph[begin:end])
+            owners.append(i)
+            shifts.append(begin)
+    return fragments, np.array(owners, dtype=np.int64), np.array(shifts, dtype=np.int64)
 
-        if segment not in maximal_segments:
-            maximal_segments[segment] = []
 
-        maximal_segments[segment].append(occurrence1)
-        maximal_segments[segment].append(occurrence2)
-        processed_segments.add(segment)
+def map_occurrences(corpus, suffix_array, repeats, focus=None, origins=None):
+    """
+    The segments of find_exact_same_segments from the (length, lb, rb) repeats.
+    origins, if given, is (paragraph of every corpus paragraph, its start in
+    that paragraph, paragraph lengths), see focus_fragments.
+    """
+    # map the occurrences of all repeats back to paragraphs in one batch
+    lengths, lbs, rbs = (np.array(column, dtype=np.int64) for column in zip(*repeats))
+    counts = rbs - lbs + 1
+    owner = np.repeat(np.arange(len(repeats)), counts)
+    sa_indices = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + lbs[owner]
+    fragment_indices, fragment_starts = corpus.locate(suffix_array[sa_indices])
+    if origins is None:
+        para_indices, start_indices, para_lengths = fragment_indices, fragment_starts, corpus.lengths
+    else:
+        para_owners, para_shifts, para_lengths = origins
+        para_indices = para_owners[fragment_indices]
+        start_indices = fragment_starts + para_shifts[fragment_indices]
+    n = len(para_lengths)
+    ratios = lengths[owner] / para_lengths[para_indices]
+    order = np.lexsort((start_indices, para_indices, owner))
+    if focus is None:
+        selected = np.ones(len(repeats), dtype=bool)
+    else:
+        in_focus = np.zeros(n, dtype=bool)
+        in_focus[list(focus)] = True
+        selected = np.logical_or.reduceat(in_focus[para_indices], np.cumsum(counts) - counts)
 
-        # Mark all substrings of the current segment as processed
-        for i in range(1, len(segment)):
-            for j in range(len(segment) - i + 1):
-                processed_segments.add(segment[j : j + i])
+    maximal_segments = {}
+    boundaries = np.cumsum(counts).tolist()
+    occurrences = list(zip(para_indices[order].tolist(), start_indices[order].tolist(), ratios[order].tolist()))
+    firsts = list(zip(fragment_indices[order].tolist(), fragment_starts[order].tolist()))
+    begin = 0
+    for length, end, keep in zip(lengths.tolist(), boundaries, selected.tolist()):
+        if not keep:
+            begin = end
+            continue
+        segment = corpus.segment(*firsts[begin], length)
+        maximal_segments[segment] = occurrences[begin:end]
+        begin = end
+    return maximal_segments
 
-    # Remove duplicate occurrences
-    for segment in maximal_segments:
-        unique_occurrences = []
-        seen = set()
-        for occurrence in maximal_segments[segment]:
-            if (occurrence[0], occurrence[1]) not in seen:
-                unique_occurrences.append(occurrence)
-                seen.add((occurrence[0], occurrence[1]))
-        maximal_segments[segment] = unique_occurrences
 
-    return {k: v for k, v in maximal_segments.items() if len(v) > 1}
+def find_pair_matches(segments, compared=None, focus=None):
+    """
+    The maximal exact matches of every pair of paragraphs, from the segments of
+    find_exact_same_segments.
 
+    A segment is maximal over all paragraphs, so two paragraphs sharing a long
+    passage also share every shorter segment inside it that a third paragraph
+    has. Each pair of occurrences of a segment is a match of the pair of
+    paragraphs, the matches contained in a longer match at the same positions
+    in both paragraphs (on the same diagonal) are dropped. What remains are the
+    matches that can't be extended in that pair, they only depend on the two
+    paragraphs, not on the others matched with them.
 
-def longest_common_prefix_length(text, i, j):
-    """Calculates the length of the longest common prefix of text[i:] and text[j:]"""
-    length = 0
-    while i < len(text) and j < len(text) and text[i] == text[j]:
-        length += 1
-        i += 1
-        j += 1
-    return length
+    Args:
+        segments: A result of find_exact_same_segments.
+        compared: Optional compared(a, b) telling whether the paragraphs a and b
+            are a pair of interest.
+        focus: Optional collection of paragraph indices, only the pairs with
+            one of them are of interest.
 
+    Returns:
+        {(paragraph a, paragraph b): list of (start in a, start in b, length,
+        segment, ratio in a, ratio in b)} with a < b, every list ordered by
+        the positions in a and b.
+    """
+    candidates = []
+    texts = list(segments)
+    for segment_index, segment in enumerate(texts):
+        occurrences = segments[segment]
+        if focus is None:
+            indices = combinations(range(len(occurrences)), 2)
+        else:
+            # the other pairs never get a look, don't enumerate them
+            inside = [x for x, occurrence in enumerate(occurrences) if occurrence[0] in focus]
+            indices = ((x, y) for x in inside for y in range(len(occurrences))
+                       if occurrences[y][0] not in focus or x < y)
+        for x, y in indices:
+            (para1, start1, _), (para2, start2, _) = occurrences[x], occurrences[y]
+            if para1 == para2 or (compared is not None and not compared(para1, para2)):
+                continue
+            if para1 > para2:
+                x, y = y, x
+            candidates.append((x, y, segment_index))
+    if not candidates:
+        return {}
 
-def find_exact_same_substrings():
-    pdf_files = collect_pdf_files()
+    first, second, owner = (np.array(column, dtype=np.int64) for column in zip(*candidates))
+    counts = np.array([len(segments[segment]) for segment in texts], dtype=np.int64)
+    bases = np.cumsum(counts) - counts
+    flat = [occurrence for segment in texts for occurrence in segments[segment]]
+    paras, starts, ratios = (np.array(column) for column in zip(*flat))
+    first, second = bases[owner] + first, bases[owner] + second
+    para_a, start_a, para_b, start_b = paras[first], starts[first], paras[second], starts[second]
+    ratio_a, ratio_b = ratios[first], ratios[second]
+    length = np.array([len(segment) for segment in texts], dtype=np.int64)[owner]
+    diagonal = start_b - start_a
+
+    # per pair and diagonal by start, longer first: a match is contained iff an
+    # earlier one of its run reaches as far, the running maximum of the ends
+    # is made monotonic over the runs by the run number
+    order = np.lexsort((-length, start_a, diagonal, para_b, para_a))
+    para_a, para_b, start_a, start_b = para_a[order], para_b[order], start_a[order], start_b[order]
+    length, diagonal, owner = length[order], diagonal[order], owner[order]
+    ratio_a, ratio_b = ratio_a[order], ratio_b[order]
+    new_run = np.r_[True, (para_a[1:] != para_a[:-1]) | (para_b[1:] != para_b[:-1])
+                    | (diagonal[1:] != diagonal[:-1])]
+    ends = start_a + length
+    keys = (np.cumsum(new_run) - 1) * (int(ends.max()) + 1) + ends
+    reach = np.maximum.accumulate(keys)
+    keep = new_run.copy()
+    keep[1:] |= reach[:-1] < keys[1:]
+
+    kept = np.nonzero(keep)[0]
+    kept = kept[np.lexsort((start_b[kept], start_a[kept], para_b[kept], para_a[kept]))]
+    matches = defaultdict(list)
+    for a, b, position_a, position_b, size, segment_index, fraction_a, fraction_b in zip(
+            *(column[kept].tolist() for column in (para_a, para_b, start_a, start_b, length, owner, ratio_a, ratio_b))):
+        matches[(a, b)].append((position_a, position_b, size, texts[segment_index], fraction_a, fraction_b))
+    return dict(matches)
+
+
+def covered_length(intervals):
+    """The number of positions covered by the (start, length) intervals."""
+    covered, reach = 0, None
+    for start, length in sorted(intervals):
+        end = start + length
+        if reach is None or start >= reach:
+            covered += length
+            reach = end
+        elif end > reach:
+            covered += end - reach
+            reach = end
+    return covered
+
+
+# batches with at least this many documents are pre-filtered by winnowing,
+# see find_candidate_pairs for the threshold and max_df knobs. max_df is off
+# (1.0) by default: text shared by most bidders may be the collusion itself,
+# as for the boilerplate masking
+PREFILTER_MIN_DOCS = int(os.environ.get("PREFILTER_MIN_DOCS", 50))
+PREFILTER_THRESHOLD = float(os.environ.get("PREFILTER_THRESHOLD", 0.0))
+PREFILTER_MAX_DF = float(os.environ.get("PREFILTER_MAX_DF", 1.0))
+# groups of more than two blocks of this many documents are matched block
+# pair by block pair, so one cluster spreads over the workers (0: never). The
+# result is the same either way, but the split costs more total work, a single
+# worker is faster without it
+COMPARE_BLOCK_DOCS = int(os.environ.get("COMPARE_BLOCK_DOCS", 16 if COMPARE_WORKERS > 1 else 0))
+
+_last_result = None
+_compare_lock = threading.Lock()
+
+
+def _no_progress(stage, percent):
+    pass
+
+
+def load_text_infos(pdf_files, progress=_no_progress):
     text_infos = []
-    for pdf_file, scaned_file in pdf_files:
+    for i, (pdf_file, scaned_file) in enumerate(pdf_files):
+        progress('loading', int(i / len(pdf_files) * 100))
         if os.path.exists(scaned_file):
-            metadata = {}
-            with open(scaned_file, 'r', encoding='utf-8') as json_file:
-                json_repr = json.load(json_file)
-                text = ''
-                start = 0
-                for text_block in json_repr['metadata']['text_block']:
-                    if text_block['type'] == 'text':
-                        text += text_block['text']
-                        metadata[start] = text_block
-                        start += len(text_block['text'])
-                text_infos.append({
-                    "text": text,
-                    "filename": pdf_file,
-                    "metadata": metadata.copy()
-                })
-
-    paragraphs = [t['text'] for t in text_infos]
-    exact_same_segments = find_exact_same_segments(paragraphs)
+            document = load_text_document(scaned_file)
+            text_infos.append({
+                "codes": document.codes,
+                "filename": pdf_file,
+                "document": document,
+                "fingerprint": document.fingerprint,
+                "winnowing": document.winnowing
+            })
+    return text_infos
+
+
+def extend_result(previous, pdf_files):
+    """
+    The result containers for the current pdf files, filled with the previous
+    result. The previous pairs never change, their relation lists are shared,
+    only the rows get the columns of the new files.
+    """
     results = defaultdict(list)
     matrix = {}
     relations = {}
+    old_matrix = {} if previous is None else previous['ratio_matrix']
+    old_relations = {} if previous is None else previous['relation_matrix']
+    if previous is not None:
+        results.update(previous['same_segments'])
+    new_files = [pdf_file for pdf_file, _ in pdf_files if pdf_file not in old_matrix]
     for pdf_file, _ in pdf_files:
-        matrix[pdf_file] = {
-            filename: 0.0 for filename, _ in pdf_files
-        }
-        relations[pdf_file] = {
-            filename: [] for filename, _ in pdf_files
-        }
-
-    for segment, occurrences in exact_same_segments.items():
-        print(f"Maximal exact-same segment: '{segment}'")
-        for para_index, start_index, ratio in occurrences:
-            print(f"  - Paragraph {para_index}, Start: {start_index}, Ratio: {ratio:.4f}")
-            metadata = text_infos[para_index]['metadata']
-            position = find_index_by_value(metadata.keys(), start_index)
-            pdf_file = text_infos[para_index]['filename']
-            results[segment].append((pdf_file, metadata[position], start_index - position, ratio))
+        if pdf_file in old_matrix:
+            matrix[pdf_file] = dict(old_matrix[pdf_file])
+            relations[pdf_file] = dict(old_relations[pdf_file])
+            for filename in new_files:
+                matrix[pdf_file][filename] = 0.0
+                relations[pdf_file][filename] = []
+        else:
+            matrix[pdf_file] = {filename: 0.0 for filename, _ in pdf_files}
+            relations[pdf_file] = {filename: [] for filename, _ in pdf_files}
+    return results, matrix, relations
+
+
+def plan_comparison(text_infos, focus=None, prefilter=None, threshold=PREFILTER_THRESHOLD,
+                    max_df=PREFILTER_MAX_DF):
+    """
+    Splits the comparison into groups of documents matched together.
 
-        for occurrent1, occurrent2 in combinations(results[segment], 2):
-            matrix[occurrent1[0]][occurrent2[0]] += occurrent1[3]
-            matrix[occurrent2[0]][occurrent1[0]] += occurrent2[3]
-            relations[occurrent1[0]][occurrent2[0]].append((segment, occurrent1[1], occurrent2[1], occurrent1[3]))
-            relations[occurrent2[0]][occurrent1[0]].append((segment, occurrent2[1], occurrent1[1], occurrent2[3]))
+    Without the prefilter all documents form one group and every pair (with a
+    document in focus, if given) is compared. With the prefilter only the pairs
+    picked by find_candidate_pairs are compared, grouped into clusters.
+
+    Groups larger than two blocks of COMPARE_BLOCK_DOCS are split further, see
+    split_group.
+
+    Returns:
+        A list of (document indices, allowed pairs or None for all pairs).
+    """
+    if prefilter is None:
+        prefilter = len(text_infos) >= PREFILTER_MIN_DOCS
+    if not prefilter:
+        if focus is not None and not focus:
+            return []
+        groups = [(list(range(len(text_infos))), None)]
+    else:
+        pairs = find_candidate_pairs([t['winnowing'] for t in text_infos], threshold, max_df, focus=focus)
+        groups = group_pairs(pairs)
+    plan = []
+    for docs, pairs in groups:
+        plan += split_group(docs, pairs, focus)
+    return plan
+
+
+def split_group(docs, pairs=None, focus=None, block_docs=COMPARE_BLOCK_DOCS):
+    """
+    Splits a group into block pairs: the documents are cut into blocks of
+    block_docs and every two blocks are matched together. A pair of documents
+    is compared by exactly one block pair, the one of its two blocks or, for
+    the pairs inside a block, the one with the next block (the last block
+    goes with the previous one).
+
+    The matches of a pair only depend on its two documents (see
+    find_pair_matches), so the split doesn't change the result. Only the
+    segments skipped for having more than max_occurrences occurrences can
+    differ, a block pair has fewer of them than the whole group. Every block
+    is matched len(blocks) - 1 times though, which is why small groups aren't
+    split.
+
+    Returns:
+        A list of (document indices, compared pairs) with a non-empty set of
+        pairs, or [(docs, pairs)] if the group isn't split.
+    """
+    if block_docs <= 0 or len(docs) <= 2 * block_docs:
+        return [(docs, pairs)]
+    blocks = [docs[i:i + block_docs] for i in range(0, len(docs), block_docs)]
+    last = len(blocks) - 1
+    shards = []
+    for i in range(len(blocks)):
+        for j in range(i + 1, len(blocks)):
+            owned = [(a, b) for a in blocks[i] for b in blocks[j]]
+            if j == i + 1:
+                owned += list(combinations(blocks[i], 2))
+            if i == last - 1 and j == last:
+                owned += list(combinations(blocks[j], 2))
+            owned = {(min(a, b), max(a, b)) for a, b in owned}
+            if pairs is not None:
+                owned &= pairs
+            elif focus is not None:
+                owned = {(a, b) for a, b in owned if a in focus or b in focus}
+            if owned:
+                shards.append((blocks[i] + blocks[j], owned))
+    return shards
+
+
+def find_exact_same_substrings(incremental=False, prefilter=None, threshold=PREFILTER_THRESHOLD,
+                               workers=COMPARE_WORKERS, progress=None, fuzzy=False, boilerplate=True,
+                               max_df=PREFILTER_MAX_DF):
+    """
+    Compares all scanned pdf files under the upload folder.
+
+    With incremental=True and a previous result whose documents are all still
+    present and unchanged, only the pairs involving the newly scanned documents
+    are computed and merged into the previous result. The relations of a pair
+    are its maximal matches (see find_pair_matches), they only depend on the
+    two documents, so the pairs of previous documents are kept as they were
+    (their relation lists are shared with the previous result). The new
+    documents are only matched against the parts of the previous documents
+    sharing text with them (see focus_fragments), so adding k documents costs
+    about k times the matching of one document, not a full comparison.
+    Without masking by document frequency and with a prefilter max_df of 1.0
+    (the defaults) the result is the one of a full comparison. Otherwise it is
+    an approximation (the candidate pairs and document frequencies of the
+    previous documents aren't recomputed), which is why incremental mode is
+    opt-in.
+
+    prefilter enables the winnowing candidate selection (see plan_comparison),
+    by default it is used for batches of PREFILTER_MIN_DOCS or more documents.
+    threshold and max_df are its knobs, see find_candidate_pairs. With a
+    threshold above 0 or a max_df below 1 the prefilter can lose pairs, its
+    result isn't the one of a full comparison then. The "prefilter" of the
+    result tells whether it ran and with which knobs.
+
+    The groups of documents to match, large ones split into block pairs (see
+    split_group), are spread over `workers` processes, the result depends
+    neither on the number of workers nor on the split.
+
+    progress, if given, is called as progress(stage, percent) with the stages
+    'loading', 'matching' and 'assembling'. Comparisons are serialized, a
+    second caller waits for the running one and usually gets its result.
+
+    fuzzy=True matches lightly edited passages too (see find_similar_segments):
+    each side of a passage is keyed by its own text in same_segments and the
+    relations get the similarity of the two sides as a 7th element.
+
+    boilerplate=True masks the template text before matching (see
+    suppress_boilerplate): the passages of the uploaded templates and, only if
+    BOILERPLATE_MAX_DF is set, those found in more than that fraction of the
+    documents. The masked fraction of every document is in the
+    "boilerplate_ratio" of the result.
+    """
+    with _compare_lock:
+        return _compare(incremental, prefilter, threshold, max_df, workers, progress or _no_progress,
+                        fuzzy, boilerplate)
 
-    return {
+
+def _compare(incremental, prefilter, threshold, max_df, workers, progress, fuzzy=False, boilerplate=True):
+    global _last_result
+    pdf_files = collect_pdf_files()
+    with COMPARE_STAGE_SECONDS.time(stage='json_load'):
+        text_infos = load_text_infos(pdf_files, progress)
+    templates, shingles = template_shingles() if boilerplate else ((), None)
+    if prefilter is None:
+        prefilter = len(text_infos) >= PREFILTER_MIN_DOCS
+    prefilter_options = (True, threshold, max_df) if prefilter else (False,)
+
+    # nothing changed since the last comparison, the result is still valid
+    result_key = (
+        tuple(pdf_file for pdf_file, _ in pdf_files),
+        tuple((t['filename'], t['fingerprint']) for t in text_infos),
+        (fuzzy, boilerplate, templates, prefilter_options)
+    )
+    if _last_result is not None and _last_result[0] == result_key:
+        COMPARES.inc(mode='cached')
+        return _last_result[1]
+
+    previous = None
+    focus = None
+    if incremental and _last_result is not None:
+        old_files, old_fingerprints, old_options = _last_result[0]
+        current_files = set(result_key[0])
+        current_fingerprints = set(result_key[1])
+        # the pairs of the previous documents are kept as they were, the
+        # document frequencies of the boilerplate index aren't recomputed for them
+        if old_options == result_key[2] and current_files.issuperset(old_files) \
+                and current_fingerprints.issuperset(old_fingerprints):
+            previous = _last_result[1]
+            old_fingerprints = set(old_fingerprints)
+            focus = {i for i, t in enumerate(text_infos)
+                     if (t['filename'], t['fingerprint']) not in old_fingerprints}
+
+    COMPARES.inc(mode='full' if previous is None else 'incremental')
+    paragraphs = [t['codes'] for t in text_infos]
+    fractions = [0.0] * len(paragraphs)
+    if boilerplate:
+        with COMPARE_STAGE_SECONDS.time(stage='boilerplate'):
+            paragraphs, fractions = suppress_boilerplate(paragraphs, template_shingles=shingles)
+    results, matrix, relations = extend_result(previous, pdf_files)
+
+    plan = plan_comparison(text_infos, focus, prefilter, threshold, max_df)
+    jobs = []
+    for docs, _ in plan:
+        group_focus = None if focus is None else [k for k, i in enumerate(docs) if i in focus]
+        jobs.append((docs, {'focus': group_focus}))
+    progress('matching', 0)
+    with COMPARE_STAGE_SECONDS.time(stage='matching'):
+        group_segments = run_sharded(find_similar_segments if fuzzy else find_exact_same_segments,
+                                     paragraphs, jobs, workers,
+                                     lambda done, total: progress('matching', int(done / total * 100)))
+
+    with COMPARE_STAGE_SECONDS.time(stage='assembly'):
+        if fuzzy:
+            assemble_similar(plan, group_segments, text_infos, focus, results, matrix, relations, progress)
+        else:
+            assemble(plan, group_segments, text_infos, focus, results, matrix, relations, progress)
+
+    result = {
         "same_segments": results,
         "ratio_matrix": matrix,
-        "relation_matrix": relations
+        "relation_matrix": relations,
+        "boilerplate_ratio": {t['filename']: fraction for t, fraction in zip(text_infos, fractions)},
+        "prefilter": {"enabled": True, "threshold": threshold, "max_df": max_df} if prefilter
+        else {"enabled": False}
     }
+    _last_result = (result_key, result)
+    return result
+
+
+def make_occurrence(text_info, start_index, length, ratio):
+    """(filename, first block, offset in that block, ratio, spans) of a segment occurrence."""
+    document = text_info['document']
+    first, spans = document.cover(start_index, length)
+    return text_info['filename'], document.block(first), spans[0]['start'], ratio, spans
+
+
+def is_compared(index1, index2, pairs, focus):
+    """Whether the plan compares the documents index1 and index2."""
+    if pairs is not None:
+        return (min(index1, index2), max(index1, index2)) in pairs
+    return focus is None or index1 in focus or index2 in focus
+
+
+def occurrence_key(occurrence):
+    """Tells the occurrences of a segment apart: the file and where its first span starts."""
+    first = occurrence[4][0]
+    return occurrence[0], first['page'], tuple(first['bbox']), first['start']
+
+
+def assemble(plan, group_segments, text_infos, focus, results, matrix, relations, progress):
+    """
+    Adds the maximal matches of every compared pair (see find_pair_matches) to
+    the result containers. The ratio of a pair is the part of the document
+    covered by its matches with the other one, overlapping matches count once.
+    """
+    occurrences = {}
+
+    def occurrence(index, start, length, ratio):
+        key = (index, start, length)
+        if key not in occurrences:
+            occurrences[key] = make_occurrence(text_infos[index], start, length, ratio)
+        return occurrences[key]
+
+    segment_places = defaultdict(set)
+    for group_index, ((docs, pairs), exact_same_segments) in enumerate(zip(plan, group_segments)):
+        progress('assembling', int(group_index / len(plan) * 100))
+        group_focus = None if focus is None else {k for k, i in enumerate(docs) if i in focus}
+        pair_matches = find_pair_matches(
+            exact_same_segments, lambda a, b: is_compared(docs[a], docs[b], pairs, focus), group_focus)
+        for (a, b), matches in pair_matches.items():
+            index1, index2 = docs[a], docs[b]
+            info1, info2 = text_infos[index1], text_infos[index2]
+            forward, backward = [], []
+            for start1, start2, length, segment, ratio1, ratio2 in matches:
+                occurrent1 = occurrence(index1, start1, length, ratio1)
+                occurrent2 = occurrence(index2, start2, length, ratio2)
+                segment_places[segment].update(((index1, start1), (index2, start2)))
+                forward.append((segment, occurrent1[1], occurrent2[1], ratio1, occurrent1[4], occurrent2[4]))
+                backward.append(((start2, start1),
+                                 (segment, occurrent2[1], occurrent1[1], ratio2, occurrent2[4], occurrent1[4])))
+            # both sides are listed in the order of their own document
+            backward = [relation for _, relation in sorted(backward, key=lambda item: item[0])]
+            # the matches of a pair are all found by the one group comparing it
+            relations[info1['filename']][info2['filename']] = forward
+            relations[info2['filename']][info1['filename']] = backward
+            matrix[info1['filename']][info2['filename']] = \
+                covered_length((m[0], m[2]) for m in matches) / max(len(info1['codes']), 1)
+            matrix[info2['filename']][info1['filename']] = \
+                covered_length((m[1], m[2]) for m in matches) / max(len(info2['codes']), 1)
+
+    files = {t['filename']: i for i, t in enumerate(text_infos)}
+    for segment, places in segment_places.items():
+        found = {occurrence_key(o): o for o in results.get(segment, [])}
+        for index, start in places:
+            o = occurrences[(index, start, len(segment))]
+            found[occurrence_key(o)] = o
+        results[segment] = [found[key] for key in sorted(found, key=lambda key: (files[key[0]], key[1:]))]
+
+
+def assemble_similar(plan, group_segments, text_infos, focus, results, matrix, relations, progress):
+    """
+    Adds the passages of find_similar_segments found in every group of the plan
+    to the result containers. The relation of a pair carries the text of the
+    source side and the similarity of the passages.
+    """
+    group_results = defaultdict(list)
+    for group_index, ((docs, pairs), passages) in enumerate(zip(plan, group_segments)):
+        progress('assembling', int(group_index / len(plan) * 100))
+        for para1, start1, length1, para2, start2, length2, similarity in passages:
+            index1, index2 = docs[para1], docs[para2]
+            if not is_compared(index1, index2, pairs, focus):
+                continue
+            info1, info2 = text_infos[index1], text_infos[index2]
+            segment1 = info1['document'].text[start1:start1 + length1]
+            segment2 = info2['document'].text[start2:start2 + length2]
+            occurrent1 = make_occurrence(info1, start1, length1, length1 / len(info1['codes']))
+            occurrent2 = make_occurrence(info2, start2, length2, length2 / len(info2['codes']))
+            for segment, occurrent in ((segment1, occurrent1), (segment2, occurrent2)):
+                if occurrent not in group_results[segment]:
+                    group_results[segment].append(occurrent)
+
+            matrix[occurrent1[0]][occurrent2[0]] += occurrent1[3]
+            matrix[occurrent2[0]][occurrent1[0]] += occurrent2[3]
+            relations[occurrent1[0]][occurrent2[0]].append(
+                (segment1, occurrent1[1], occurrent2[1], occurrent1[3], occurrent1[4], occurrent2[4], similarity))
+            relations[occurrent2[0]][occurrent1[0]].append(
+                (segment2, occurrent2[1], occurrent1[1], occurrent2[3], occurrent2[4], occurrent1[4], similarity))
+
+    for segment, occurrence_list in group_results.items():
+        files = {o[0] for o in occurrence_list}
+        results[segment] = [o for o in results.get(segment, []) if o[0] not in files] + occurrence_list
 
 
 if __name__ == '__main__':
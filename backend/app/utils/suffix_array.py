@@ -0,0 +1,184 @@
+import numpy as np
+
+
+def build_suffix_array(codes):
+    """
+    Builds the suffix array of an integer-encoded text by prefix doubling.
+
+    Every round sorts the suffixes by the pair (rank of the first k symbols,
+    rank of the next k symbols). As in Larsson-Sadakane, suffixes whose group
+    is already a singleton are never sorted again, so after the first rounds
+    only the repeated regions of the text are still being worked on.
+
+    Args:
+        codes: A 1-d integer array (e.g. unicode codepoints).
+
+    Returns:
+        A numpy int64 array with the start positions of the suffixes in
+        lexicographical order.
+    """
+    codes = np.asarray(codes)
+    n = len(codes)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+    suffix_array = np.argsort(codes, kind="stable").astype(np.int64)
+    slots = np.arange(n, dtype=np.int64)
+    sorted_codes = codes[suffix_array]
+    heads = np.ones(n, dtype=bool)
+    heads[1:] = sorted_codes[1:] != sorted_codes[:-1]
+    # the rank of a suffix is the slot of the first suffix of its group
+    rank = np.empty(n, dtype=np.int64)
+    rank[suffix_array] = np.maximum.accumulate(np.where(heads, slots, 0))
+    active = slots[_in_groups(heads)]
+
+    k = 1
+    while active.size:
+        positions = suffix_array[active]
+        second = np.full(active.size, -1, dtype=np.int64)
+        inside = positions + k < n
+        second[inside] = rank[positions[inside] + k]
+        first = rank[positions]
+        order = np.lexsort((second, first))
+        positions, first, second = positions[order], first[order], second[order]
+        suffix_array[active] = positions
+
+        heads = np.ones(active.size, dtype=bool)
+        heads[1:] = (first[1:] != first[:-1]) | (second[1:] != second[:-1])
+        rank[positions] = np.maximum.accumulate(np.where(heads, active, 0))
+        active = active[_in_groups(heads)]
+        k *= 2
+    return suffix_array
+
+
+def _in_groups(heads):
+    """Flags the members of groups with more than one element."""
+    single = heads.copy()
+    single[:-1] &= heads[1:]
+    return ~single
+
+
+def build_lcp_array(codes, suffix_array, probe=8):
+    """
+    Kasai's linear time LCP construction.
+
+    The first `probe` symbols of every adjacent pair are compared with numpy;
+    the Kasai scan then only runs over the suffixes that share at least that
+    many symbols with their predecessor, which on natural text is a small
+    fraction of the corpus.
+
+    Returns an int64 array where lcp[i] is the length of the longest common
+    prefix of the suffixes suffix_array[i - 1] and suffix_array[i] (lcp[0] = 0).
+    """
+    codes = np.asarray(codes)
+    suffix_array = np.asarray(suffix_array)
+    n = len(suffix_array)
+    lcp = np.zeros(n, dtype=np.int64)
+    if n < 2:
+        return lcp
+    current, previous = suffix_array[1:], suffix_array[:-1]
+    matching = np.ones(n - 1, dtype=bool)
+    for j in range(probe):
+        inside = matching & (current + j < n) & (previous + j < n)
+        equal = np.zeros(n - 1, dtype=bool)
+        equal[inside] = codes[current[inside] + j] == codes[previous[inside] + j]
+        matching &= equal
+        lcp[1:] += matching
+    if not matching.any():
+        return lcp
+
+    # Kasai over the text positions with lcp >= probe. lcp(p + 1) >= lcp(p) - 1
+    # still holds, so h is carried along runs of consecutive positions.
+    long_ranks = np.nonzero(matching)[0] + 1
+    long_positions = suffix_array[long_ranks]
+    order = np.argsort(long_positions)
+    long_ranks, long_positions = long_ranks[order], long_positions[order]
+    # None never equals a code, so the scan stops at the end of the text
+    # without an explicit bound check in the inner loop.
+    text = codes.tolist()
+    text.append(None)
+    predecessors = suffix_array[long_ranks - 1].tolist()
+    h, last = 0, -2
+    for p, q, r in zip(long_positions.tolist(), predecessors, long_ranks.tolist()):
+        h = max(h - 1, probe) if p == last + 1 else probe
+        while text[p + h] == text[q + h]:
+            h += 1
+        lcp[r] = h
+        last = p
+    return lcp
+
+
+def find_maximal_repeats(codes, suffix_array, lcp, min_len, groups=None, max_occurrences=None):
+    """
+    Enumerates the maximal repeats of at least min_len symbols with a
+    bottom-up traversal of the lcp-intervals.
+
+    Every lcp-interval [lb, rb] with value l stands for the string shared by
+    suffix_array[lb..rb]; it is right-maximal by construction. It is reported
+    only if it is also left-diverse, i.e. its occurrences are not all preceded
+    by the same symbol, so no repeat is ever contained in a longer one with
+    exactly the same occurrences. Nothing but interval bounds is materialized.
+
+    Args:
+        codes: The integer-encoded text.
+        suffix_array: Its suffix array.
+        lcp: Its LCP array (see build_lcp_array).
+        min_len: The minimum length of a reported repeat.
+        groups: Optional array assigning a group (e.g. a document) to every
+            text position. If given, only repeats occurring in at least two
+            different groups are reported.
+        max_occurrences: Optional upper bound on the number of occurrences of a
+            reported repeat. Periodic runs (dot leaders, underlines, ...) have
+            a maximal repeat for every period multiple, each occurring almost
+            everywhere in the run, so this keeps the output bounded.
+
+    Returns:
+        A list of (length, lb, rb) tuples, the occurrences of the repeat start
+        at suffix_array[lb:rb + 1].
+    """
+    n = len(suffix_array)
+    if n < 2:
+        return []
+    suffix_array = np.asarray(suffix_array)
+    codes = np.asarray(codes)
+    # left symbol of every suffix in suffix array order, -1 marks "diverse"
+    left = np.full(n, -1, dtype=np.int64)
+    has_left = suffix_array > 0
+    left[has_left] = codes[suffix_array[has_left] - 1]
+    if groups is None:
+        group = np.zeros(n, dtype=np.int64)
+    else:
+        group = np.asarray(groups)[suffix_array].astype(np.int64)
+
+    # lcp values below min_len never open an interval we are interested in,
+    # so only positions inside or right after a run of long lcps are visited.
+    heights = np.zeros(n + 1, dtype=np.int64)
+    heights[:n] = np.where(np.asarray(lcp) >= min_len, lcp, 0)
+    heights[0] = 0
+    is_long = heights > 0
+    active = np.nonzero(is_long[1:] | is_long[:-1])[0] + 1
+
+    repeats = []
+    # stack entries: [lcp value, left bound, left symbol, group]
+    stack = [[0, 0, -1, -1]]
+    for i, h, leaf_left, leaf_group in zip(active.tolist(), heights[active].tolist(),
+                                           left[active - 1].tolist(), group[active - 1].tolist()):
+        lb = i - 1
+        while h < stack[-1][0]:
+            top = stack.pop()
+            if top[2] != leaf_left:
+                top[2] = -1
+            if top[3] != leaf_group:
+                top[3] = -1
+            if top[2] == -1 and (groups is None or top[3] == -1) and \
+                    (max_occurrences is None or i - top[1] <= max_occurrences):
+                repeats.append((top[0], top[1], i - 1))
+            leaf_left, leaf_group, lb = top[2], top[3], top[1]
+        top = stack[-1]
+        if h > top[0]:
+            stack.append([h, lb, leaf_left, leaf_group])
+        else:
+            if top[2] != leaf_left:
+                top[2] = -1
+            if top[3] != leaf_group:
+                top[3] = -1
+    return repeats
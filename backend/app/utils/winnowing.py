@@ -0,0 +1,143 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Every exact match of at least WINNOW_K + WINNOW_WINDOW - 1 characters shares
+# at least one fingerprint.
+WINNOW_K = 8
+WINNOW_WINDOW = 8
+HASH_BASE = np.uint64(1000003)
+
+
+def kgram_hashes(codes, k=WINNOW_K):
+    """Polynomial (mod 2^64) hashes of all k-grams of an integer array."""
+    codes = np.asarray(codes, dtype=np.uint64)
+    count = len(codes) - k + 1
+    if count <= 0:
+        return np.zeros(0, dtype=np.uint64)
+    hashes = np.zeros(count, dtype=np.uint64)
+    for j in range(k):
+        hashes = hashes * HASH_BASE + codes[j:j + count]
+    # splitmix64 finalizer, so that the window minimum isn't biased towards
+    # k-grams starting with small codepoints
+    hashes ^= hashes >> np.uint64(30)
+    hashes *= np.uint64(0xbf58476d1ce4e5b9)
+    hashes ^= hashes >> np.uint64(27)
+    hashes *= np.uint64(0x94d049bb133111eb)
+    hashes ^= hashes >> np.uint64(31)
+    return hashes
+
+
+def winnow(text, k=WINNOW_K, window=WINNOW_WINDOW):
+    """
+    Winnowing fingerprints (Schleimer et al.) of a text: the minimum k-gram
+    hash of every window of `window` consecutive k-grams.
+
+    Returns:
+        A sorted numpy array of distinct uint64 fingerprints.
+    """
+    codes = np.frombuffer(text.encode('utf-32-le', 'surrogatepass'), dtype=np.uint32)
+    hashes = kgram_hashes(codes, k)
+    if len(hashes) == 0:
+        return hashes
+    if len(hashes) <= window:
+        return hashes.min(keepdims=True)
+    windows = sliding_window_view(hashes, window)
+    selected = np.arange(len(windows)) + windows.argmin(axis=1)
+    return np.unique(hashes[selected])
+
+
+def find_candidate_pairs(fingerprints, threshold=0.0, max_df=1.0, focus=None):
+    """
+    Picks the document pairs worth an exact comparison.
+
+    Args:
+        fingerprints: One fingerprint array (see winnow) per document.
+        threshold: The recall knob. A pair is a candidate if the shared
+            fingerprints cover at least this fraction of the smaller document's
+            fingerprints. With 0.0 every pair sharing a fingerprint (below
+            max_df) is kept.
+        max_df: Fingerprints found in more than this fraction of the documents
+            are template text and don't make a pair a candidate. A pair whose
+            only matches of WINNOW_K + WINNOW_WINDOW - 1 or more characters
+            consist of such fingerprints is lost, with 1.0 (the default) every
+            pair sharing a fingerprint is kept.
+        focus: Optional collection of document indices, only pairs with at
+            least one document in it are returned.
+
+    Returns:
+        A set of (i, j) document index tuples with i < j.
+    """
+    n = len(fingerprints)
+    if n < 2:
+        return set()
+    sizes = np.array([len(f) for f in fingerprints], dtype=np.int64)
+    all_hashes = np.concatenate(fingerprints) if sizes.sum() else np.zeros(0, dtype=np.uint64)
+    all_docs = np.repeat(np.arange(n, dtype=np.int64), sizes)
+    order = np.argsort(all_hashes, kind='stable')
+    all_hashes, all_docs = all_hashes[order], all_docs[order]
+
+    starts = np.nonzero(np.r_[True, all_hashes[1:] != all_hashes[:-1]])[0]
+    dfs = np.diff(np.r_[starts, len(all_hashes)])
+    max_count = max(2, int(max_df * n))
+    in_focus = None
+    if focus is not None:
+        in_focus = np.zeros(n, dtype=bool)
+        in_focus[list(focus)] = True
+
+    pair_keys = []
+    triangles = {}
+    for start, df in zip(starts[dfs >= 2].tolist(), dfs[dfs >= 2].tolist()):
+        if df > max_count:
+            continue
+        docs = all_docs[start:start + df]
+        if df not in triangles:
+            triangles[df] = np.triu_indices(df, 1)
+        first, second = triangles[df]
+        a, b = docs[first], docs[second]
+        if in_focus is not None:
+            keep = in_focus[a] | in_focus[b]
+            a, b = a[keep], b[keep]
+        pair_keys.append(a * n + b)
+    if not pair_keys:
+        return set()
+
+    keys, shared = np.unique(np.concatenate(pair_keys), return_counts=True)
+    a, b = keys // n, keys % n
+    smaller = np.maximum(np.minimum(sizes[a], sizes[b]), 1)
+    keep = shared / smaller >= threshold
+    return set(zip(a[keep].tolist(), b[keep].tolist()))
+
+
+def group_pairs(pairs):
+    """
+    Splits candidate pairs into connected clusters of documents.
+
+    Returns:
+        A list of (sorted document indices, pairs inside the cluster).
+    """
+    parent = {}
+
+    def find(x):
+        root = x
+        while parent[root] != root:
+            root = parent[root]
+        while parent[x] != root:
+            parent[x], x = root, parent[x]
+        return root
+
+    for a, b in pairs:
+        parent.setdefault(a, a)
+        parent.setdefault(b, b)
+        ra, rb = find(a), find(b)
+        if ra != rb:
+            parent[max(ra, rb)] = min(ra, rb)
+
+    clusters = {}
+    for a, b in sorted(pairs):
+        clusters.setdefault(find(a), set()).add((a, b))
+    groups = []
+    for root in sorted(clusters):
+        cluster_pairs = clusters[root]
+        docs = sorted({d for pair in cluster_pairs for d in pair})
+        groups.append((docs, cluster_pairs))
+    return groups
@@ -0,0 +1,229 @@
+"""
+Benchmarks of the comparison engine on synthetic tender corpora.
+
+Every profile runs in its own process: a corpus is generated into a temporary
+folder, then every stage of the comparison is timed (best of --repeat runs)
+and run once more under tracemalloc for its peak memory. The results are
+compared with baselines.json, a stage slower or bigger than its baseline by
+more than the tolerance is reported as a regression (exit status 1).
+
+    cd backend
+    python -m benchmarks.bench                    # small and medium
+    python -m benchmarks.bench --profile large
+    python -m benchmarks.bench --save             # store the results as the baselines
+
+The baselines are machine specific, re-save them when the hardware changes.
+"""
+import os
+import sys
+import gc
+import json
+import time
+import random
+import argparse
+import resource
+import tempfile
+import subprocess
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCH_DIR), 'app'))
+
+from benchmarks.synthetic import make_tender_corpus, random_paragraphs  # noqa: E402
+from benchmarks.oracle import check_segments, check_pair_matches  # noqa: E402
+
+BASELINES = os.path.join(BENCH_DIR, 'baselines.json')
+
+PROFILES = {
+    'small': dict(documents=10, length=10000, shared_rate=0.05, boilerplate_ratio=0.1),
+    'medium': dict(documents=40, length=30000, shared_rate=0.05, boilerplate_ratio=0.1),
+    'large': dict(documents=100, length=60000, shared_rate=0.03, boilerplate_ratio=0.2),
+    'boilerplate': dict(documents=40, length=30000, shared_rate=0.02, boilerplate_ratio=0.5),
+}
+DEFAULT_PROFILES = ['small', 'medium']
+
+# a regression must exceed the baseline by this factor and by the noise floor
+TIME_TOLERANCE = 0.25
+TIME_FLOOR = 0.05
+MEMORY_TOLERANCE = 0.25
+MEMORY_FLOOR = 4.0
+
+
+def measure(func, repeat):
+    """
+    Returns:
+        (result of func, best wall time in seconds, peak traced memory in MB)
+    """
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+        del result
+    gc.collect()
+    tracemalloc.start()
+    result = func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, best, peak / 2 ** 20
+
+
+def run_profile(name, repeat):
+    from utils import ssf
+    from utils.corpus import Corpus
+    from utils.doc_cache import clear_text_cache, get_text_path
+    from utils.suffix_array import build_suffix_array, build_lcp_array, find_maximal_repeats
+    from utils.boilerplate import suppress_boilerplate
+
+    stages = {}
+
+    def stage(stage_name, func):
+        result, seconds, peak = measure(func, repeat)
+        stages[stage_name] = {'seconds': round(seconds, 4), 'peak_mb': round(peak, 2)}
+        return result
+
+    with tempfile.TemporaryDirectory() as folder:
+        os.chdir(folder)
+        pdf_files = make_tender_corpus(os.path.join('uploads', 'batch'), **PROFILES[name])
+
+        def load_json():
+            clear_text_cache()
+            for _, scaned_file in pdf_files:
+                if os.path.exists(get_text_path(scaned_file)):
+                    os.remove(get_text_path(scaned_file))
+            return ssf.load_text_infos(pdf_files)
+
+        def load_text():
+            clear_text_cache()
+            return ssf.load_text_infos(pdf_files)
+
+        def compare():
+            ssf._last_result = None
+            return ssf.find_exact_same_substrings(prefilter=False, workers=1)
+
+        stage('json_load', load_json)
+        text_infos = stage('text_load', load_text)
+        paragraphs = [t['codes'] for t in text_infos]
+        # the document-frequency index, opt-in in the app
+        stage('boilerplate', lambda: suppress_boilerplate(paragraphs, max_df=0.5))
+        corpus = stage('corpus', lambda: Corpus(paragraphs))
+        suffix_array = stage('suffix_sort', lambda: build_suffix_array(corpus.codes))
+        lcp = stage('lcp', lambda: build_lcp_array(corpus.codes, suffix_array))
+        stage('maximal_repeats', lambda: find_maximal_repeats(corpus.codes, suffix_array, lcp, 4,
+                                                              corpus.doc_ids, 1000))
+        stage('segments', lambda: ssf.find_exact_same_segments(paragraphs))
+        result = stage('compare', compare)
+        os.chdir(BENCH_DIR)
+
+    return {
+        'profile': name,
+        'characters': sum(len(p) for p in paragraphs),
+        'segments': len(result['same_segments']),
+        'stages': stages,
+        'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    }
+
+
+# fixed oracle cases, each one once broke the engine
+REGRESSION_CASES = [
+    # two identical documents and two partial copies: the shorter segments
+    # shared with the copies are inside the long match of the identical pair
+    (['甲乙丙丁戊己庚辛'] * 2 + ['甲乙丙丁子丑寅卯', '辰巳午未戊己庚辛'], 4),
+]
+
+
+def run_oracle(cases, seed=0):
+    from utils.ssf import find_exact_same_segments, find_pair_matches
+    rng = random.Random(seed)
+    inputs = [(random_paragraphs(rng), rng.randint(1, 4)) for _ in range(cases)]
+    return check_segments(find_exact_same_segments, inputs + REGRESSION_CASES) \
+        + check_pair_matches(find_exact_same_segments, find_pair_matches, inputs + REGRESSION_CASES) \
+        + check_pair_matches(find_exact_same_segments, find_pair_matches, inputs + REGRESSION_CASES, focus={0})
+
+
+def compare_with_baseline(report, baseline):
+    """Returns the regressions of report against baseline as messages."""
+    regressions = []
+    for stage_name, current in report['stages'].items():
+        base = baseline['stages'].get(stage_name, None)
+        if base is None:
+            continue
+        if current['seconds'] > base['seconds'] * (1 + TIME_TOLERANCE) \
+                and current['seconds'] - base['seconds'] > TIME_FLOOR:
+            regressions.append(f"{stage_name}: {base['seconds']:.3f}s -> {current['seconds']:.3f}s")
+        if current['peak_mb'] > base['peak_mb'] * (1 + MEMORY_TOLERANCE) \
+                and current['peak_mb'] - base['peak_mb'] > MEMORY_FLOOR:
+            regressions.append(f"{stage_name}: {base['peak_mb']:.1f}MB -> {current['peak_mb']:.1f}MB")
+    if report['max_rss_mb'] > baseline['max_rss_mb'] * (1 + MEMORY_TOLERANCE) \
+            and report['max_rss_mb'] - baseline['max_rss_mb'] > MEMORY_FLOOR:
+        regressions.append(f"max rss: {baseline['max_rss_mb']:.1f}MB -> {report['max_rss_mb']:.1f}MB")
+    return regressions
+
+
+def print_report(report, baseline):
+    print(f"== {report['profile']}: {report['characters']} characters, {report['segments']} segments, "
+          f"max rss {report['max_rss_mb']}MB")
+    for stage_name, current in report['stages'].items():
+        line = f"  {stage_name:<16} {current['seconds']:>9.4f}s {current['peak_mb']:>9.2f}MB"
+        if baseline is not None and stage_name in baseline['stages']:
+            base = baseline['stages'][stage_name]
+            line += f"   (baseline {base['seconds']:.4f}s {base['peak_mb']:.2f}MB)"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the comparison engine")
+    parser.add_argument('--profile', action='append', choices=sorted(PROFILES),
+                        help="profile to run, can be repeated (default: small and medium)")
+    parser.add_argument('--repeat', type=int, default=3, help="timed runs per stage, the best one counts")
+    parser.add_argument('--oracle', type=int, default=300, help="random oracle cases, 0 to skip")
+    parser.add_argument('--save', action='store_true', help="store the results as the baselines")
+    parser.add_argument('--json', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.json:
+        # the child process of a single profile
+        print(json.dumps(run_profile(args.profile[0], args.repeat)))
+        return 0
+
+    if args.oracle:
+        failures = run_oracle(args.oracle)
+        total = 3 * (args.oracle + len(REGRESSION_CASES))
+        print(f"oracle: {total - len(failures)}/{total} checks match the brute force")
+        for paragraphs, min_len in failures[:5]:
+            print(f"  mismatch: min_len={min_len} {paragraphs}")
+        if failures:
+            return 1
+
+    baselines = {}
+    if os.path.exists(BASELINES):
+        with open(BASELINES) as f:
+            baselines = json.load(f)
+
+    regressions = []
+    for name in args.profile or DEFAULT_PROFILES:
+        # a fresh process per profile, so max rss belongs to this profile only
+        output = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.bench', '--json', '--profile', name, '--repeat', str(args.repeat)],
+            cwd=os.path.dirname(BENCH_DIR), check=True, stdout=subprocess.PIPE, text=True).stdout
+        report = json.loads(output.strip().splitlines()[-1])
+        print_report(report, baselines.get(name, None))
+        if args.save:
+            baselines[name] = report
+        elif name in baselines:
+            regressions += [f"{name} {message}" for message in compare_with_baseline(report, baselines[name])]
+
+    if args.save:
+        with open(BASELINES, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"baselines saved to {BASELINES}")
+    for message in regressions:
+        print(f"REGRESSION {message}")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,94 @@
+def brute_force_segments(paragraphs, min_len=4):
+    """
+    The result of find_exact_same_segments computed the slow way: every
+    substring of every paragraph is a candidate, it is kept if it occurs in
+    two paragraphs and can be extended neither to the left nor to the right
+    without losing an occurrence. Only usable for tiny inputs.
+    """
+    occurrences = {}
+    for d, paragraph in enumerate(paragraphs):
+        for i in range(len(paragraph)):
+            for j in range(i + min_len, len(paragraph) + 1):
+                occurrences.setdefault(paragraph[i:j], []).append((d, i))
+
+    segments = {}
+    for segment, places in occurrences.items():
+        if len({d for d, _ in places}) < 2:
+            continue
+        # a paragraph boundary counts as a character of its own
+        lefts = {paragraphs[d][i - 1] if i > 0 else ('start', d, i) for d, i in places}
+        ends = [(d, i + len(segment)) for d, i in places]
+        rights = {paragraphs[d][j] if j < len(paragraphs[d]) else ('end', d, j) for d, j in ends}
+        if len(lefts) > 1 and len(rights) > 1:
+            segments[segment] = sorted((d, i, len(segment) / len(paragraphs[d])) for d, i in places)
+    return segments
+
+
+def check_segments(find_segments, cases):
+    """
+    Compares find_segments(paragraphs, min_len) with the brute force for
+    every (paragraphs, min_len) in cases.
+
+    Returns:
+        A list of the failing (paragraphs, min_len).
+    """
+    failures = []
+    for paragraphs, min_len in cases:
+        got = {segment: sorted(places) for segment, places in find_segments(paragraphs, min_len).items()}
+        if got != brute_force_segments(paragraphs, min_len):
+            failures.append((paragraphs, min_len))
+    return failures
+
+
+def brute_force_pair_matches(paragraphs, min_len=4):
+    """
+    The result of find_pair_matches computed the slow way: for every pair of
+    paragraphs every pair of positions starting a common run of at least
+    min_len characters that can be extended neither to the left nor to the
+    right in that pair.
+    """
+    matches = {}
+    for a in range(len(paragraphs)):
+        for b in range(a + 1, len(paragraphs)):
+            text_a, text_b = paragraphs[a], paragraphs[b]
+            found = []
+            for i in range(len(text_a)):
+                for j in range(len(text_b)):
+                    if i > 0 and j > 0 and text_a[i - 1] == text_b[j - 1]:
+                        continue
+                    length = 0
+                    while i + length < len(text_a) and j + length < len(text_b) \
+                            and text_a[i + length] == text_b[j + length]:
+                        length += 1
+                    if length >= min_len:
+                        found.append((i, j, length))
+            if found:
+                matches[(a, b)] = sorted(found)
+    return matches
+
+
+def check_pair_matches(find_segments, find_pair_matches, cases, focus=None):
+    """
+    Compares the pair matches of find_segments(paragraphs, min_len) with the
+    brute force for every (paragraphs, min_len) in cases. With a focus (a set
+    of paragraph indices) only the pairs with one of them are compared, the
+    segments are found with that focus.
+
+    Returns:
+        A list of the failing (paragraphs, min_len).
+    """
+    failures = []
+    for paragraphs, min_len in cases:
+        segments = find_segments(paragraphs, min_len) if focus is None \
+            else find_segments(paragraphs, min_len, focus=focus)
+        got = {
+            pair: [(start_a, start_b, length) for start_a, start_b, length, *_ in matches]
+            for pair, matches in find_pair_matches(segments, focus=focus).items()
+        }
+        expected = {
+            pair: matches for pair, matches in brute_force_pair_matches(paragraphs, min_len).items()
+            if focus is None or pair[0] in focus or pair[1] in focus
+        }
+        if got != expected:
+            failures.append((paragraphs, min_len))
+    return failures
@@ -0,0 +1,81 @@
+import os
+import json
+import random
+
+# common CJK ideographs, the synthetic text is drawn from these
+ALPHABET = [chr(0x4e00 + i) for i in range(3000)]
+PUNCTUATION = '，。；：、'
+
+
+def random_text(rng, length):
+    chars = []
+    while len(chars) < length:
+        chars.extend(rng.choice(ALPHABET) for _ in range(rng.randint(8, 30)))
+        chars.append(rng.choice(PUNCTUATION))
+    return ''.join(chars[:length])
+
+
+def make_tender_corpus(folder, documents=20, length=20000, shared_rate=0.05, boilerplate_ratio=0.1,
+                       block_size=200, seed=0):
+    """
+    Writes a synthetic batch of scanned tenders into folder: for every document
+    an empty .pdf and a .pdf.json in the shape of the KBPort output.
+
+    Args:
+        documents: The number of documents.
+        length: The text length of every document.
+        shared_rate: The probability of a block being copied (in part) from
+            a pool of passages shared between the documents.
+        boilerplate_ratio: The part of every document taken from a template
+            all documents start with.
+        block_size: The length of a text block, there are 10 blocks per page.
+        seed: Seed of the random generator, the corpus only depends on the
+            arguments.
+
+    Returns:
+        A list of (pdf file, scanned file).
+    """
+    rng = random.Random(seed)
+    os.makedirs(folder, exist_ok=True)
+    boilerplate = random_text(rng, int(length * boilerplate_ratio))
+    shared = [random_text(rng, block_size * 3) for _ in range(max(documents // 2, 1))]
+    pdf_files = []
+    for d in range(documents):
+        text = boilerplate
+        while len(text) < length:
+            if rng.random() < shared_rate:
+                passage = rng.choice(shared)
+                start = rng.randrange(len(passage) // 2)
+                text += passage[start:start + rng.randint(block_size // 4, block_size * 2)]
+            else:
+                text += random_text(rng, block_size)
+        text = text[:length]
+
+        text_blocks = []
+        for b, start in enumerate(range(0, len(text), block_size)):
+            row = b % 10
+            text_blocks.append({
+                'type': 'text',
+                'text': text[start:start + block_size],
+                'page': b // 10,
+                'bbox': [50, 60 + row * 70, 545, 120 + row * 70]
+            })
+            if b % 7 == 0:
+                text_blocks.append({'type': 'image', 'page': b // 10, 'bbox': [50, 50, 100, 100]})
+
+        pdf_file = os.path.join(folder, f"tender{d:04d}.pdf")
+        scaned_file = pdf_file + '.json'
+        with open(pdf_file, 'wb') as f:
+            f.write(b'%PDF-1.4\n')
+        with open(scaned_file, 'w') as f:
+            json.dump({'metadata': {'text_block': text_blocks}}, f, ensure_ascii=False)
+        pdf_files.append((pdf_file, scaned_file))
+    return pdf_files
+
+
+def random_paragraphs(rng, alphabet='ab甲', count=(2, 5), length=(0, 25)):
+    """Small random inputs for the oracle check."""
+    return [
+        ''.join(rng.choice(alphabet) for _ in range(rng.randint(*length)))
+        for _ in range(rng.randint(*count))
+    ]